@@ -1,52 +1,405 @@
-from disk import Disk
-from custom_crypt import SectorCrypt
+from disk import Disk, ImageDisk, MmapDisk, coalesce
+from custom_crypt import SectorCrypt, XTSCrypt, ParallelCrypt, CIPHERS, NOISE_LEGACY
+from keyslot import KeySlots
+from cache import BlockCache
+from prefetch import ReadAhead
+from pipeline import WritePipeline, PipelineCancelled
+from compress import CODECS, CODEC_IDS, compressible
+import agent
+import contextlib
+import getpass
+import io
 import os
+import shutil
+import sys
+import struct
+import tracemalloc
+import numpy as np
+import zlib
 from tkinter import *
-from tkinter.filedialog import askopenfilename
+from tkinter.filedialog import askopenfilename, askdirectory
 from typing import Generator
+from collections import OrderedDict
 import time
 
 class Inode:
-    """Inode class to handle inode operations"""
+    """Inode class to handle inode operations
+    64 octets: valid + flags (1) + size (7) packed in one big endian Q, name (32), direct[4], indirect, double indirect (4 each)
+    """
+    __slots__ = ("valid", "flags", "size", "name", "direct", "indirect", "double_indirect", "position")
+    layout = struct.Struct(">Q32s6I")
+    too_big = 1024**4
+
     def __init__(self, data:bytes, offset:int=0):
-        self.valid = data[0] == 1
+        self.position = offset
+        self.valid = data[0] & INODE_VALID == INODE_VALID and data[0] & ~INODE_FLAGS == 0
+        self.flags = data[0] & ~INODE_VALID if self.valid else 0
         if not self.valid:
             self.size = 0
             self.name = ""
             self.direct = [0]*4
             self.indirect = 0
             self.double_indirect = 0
-            self.position = offset
             return
-        self.size = int.from_bytes(data[1:8], byteorder="big")
-        too_big = 1024**4
-        if self.size > too_big or self.size <= 0:
+        self.set_fields(self.layout.unpack_from(data))
+
+    def set_fields(self, fields:tuple):
+        header, name, direct0, direct1, direct2, direct3, self.indirect, self.double_indirect = fields
+        self.size = header & 0xFFFFFFFFFFFFFF
+        if self.size > self.too_big:
             raise ValueError(f"File size too big: {self.size} bytes")
-        self.name = data[8:40].decode('utf-8').strip("\x00")
-        self.direct = [int.from_bytes(data[i:i+4], byteorder="big") for i in range(40, 56, 4)]
-        self.indirect = int.from_bytes(data[56:60], byteorder="big")
-        self.double_indirect = int.from_bytes(data[60:64], byteorder="big")
-        self.position = offset
+        self.name = name.decode('utf-8').strip("\x00")
+        self.direct = [direct0, direct1, direct2, direct3]
+
+    @classmethod
+    def from_block(cls, block:bytes, first_position:int=0)->list:
+        """Valid inodes of a whole inode block, unpacked in one iter_unpack call (invalid/corrupted slots are skipped)"""
+        inodes = []
+        new = cls.__new__
+        for slot, (header, name, direct0, direct1, direct2, direct3, indirect, double_indirect) in enumerate(cls.layout.iter_unpack(block)):
+            flags = header >> 56
+            if flags & INODE_VALID == 0 or flags & ~INODE_FLAGS:
+                continue
+            size = header & 0xFFFFFFFFFFFFFF
+            try:
+                if size > cls.too_big:
+                    raise ValueError(f"File size too big: {size} bytes")
+                name = name.decode('utf-8').strip("\x00")
+            except ValueError as e:
+                if DEBUG:print(f"[-] Error reading inode: {e}")
+                continue
+            inode = new(cls)
+            inode.valid = True
+            inode.flags = flags & ~INODE_VALID
+            inode.size = size
+            inode.name = name
+            inode.direct = [direct0, direct1, direct2, direct3]
+            inode.indirect = indirect
+            inode.double_indirect = double_indirect
+            inode.position = first_position+slot
+            inodes.append(inode)
+        return inodes
+
+    @classmethod
+    def from_fields(cls, fields:tuple, position:int):
+        """Valid inode from unpacked layout fields"""
+        inode = cls.__new__(cls)
+        inode.valid = True
+        inode.flags = fields[0] >> 56 & ~INODE_VALID
+        inode.position = position
+        inode.set_fields(fields)
+        return inode
+
+    def is_directory(self)->bool:
+        return bool(self.flags & INODE_DIRECTORY)
+
+    def is_small(self)->bool:
+        """Data in the inode (inline) or in a shared tail block"""
+        return bool(self.flags & (INODE_INLINE | INODE_TAIL))
+
+    def inline_data(self)->bytes:
+        """Data of an inline file: stored in place of the 6 pointers (24 octets)"""
+        return struct.pack(">6I", *self.direct, self.indirect, self.double_indirect)[:self.size]
+
+    def set_inline_data(self, data:bytes):
+        pointers = struct.unpack(">6I", bytes(data).ljust(INLINE_SIZE, b"\x00"))
+        self.direct, self.indirect, self.double_indirect = list(pointers[:4]), pointers[4], pointers[5]
 
     def __str__(self):
         return f"Inode: {self.name} ({self.size} bytes)"
 
     def to_bytes(self):
-        data = b"\x01" if self.valid else b"\x00"
-        data += self.size.to_bytes(7, byteorder="big")
-        data += self.name.encode('utf-8').ljust(32, b"\x00")
-        data += b"".join([i.to_bytes(4, byteorder="big") for i in self.direct])
-        data += self.indirect.to_bytes(4, byteorder="big")
-        data += self.double_indirect.to_bytes(4, byteorder="big")
-        return data
+        name = self.name.encode('utf-8')
+        if len(name) > 32:#nested inodes: the full name is in the directory entry, cut on a character boundary
+            name = name[:32].decode('utf-8', 'ignore').encode('utf-8')
+        return self.layout.pack((INODE_VALID | self.flags if self.valid else 0) << 56 | self.size, name,
+                                *self.direct, self.indirect, self.double_indirect)
+
+
+def benchmark_inodes(blocks:int=2000)->dict:
+    """Inode codec speed (inodes/s): one Inode per slot, whole block (from_block), to_bytes, and memory per Inode (octets)"""
+    inodes = []
+    for slot in range(64):
+        inode = Inode(b"\x00", slot)
+        inode.valid, inode.size, inode.name = True, 4096*(slot+1), f"file{slot}"
+        inode.direct, inode.indirect, inode.double_indirect = [slot*4+i+1000 for i in range(4)], 0, 0
+        inodes.append(inode)
+    block = b"".join(inode.to_bytes() for inode in inodes)
+    results = {}
+    t1 = time.perf_counter()
+    for _ in range(blocks):
+        [Inode(block[j:j+64], j//64) for j in range(0, len(block), 64)]
+    results["decode"] = blocks*64/(time.perf_counter()-t1)
+    t1 = time.perf_counter()
+    for _ in range(blocks):
+        Inode.from_block(block)
+    results["bulk_decode"] = blocks*64/(time.perf_counter()-t1)
+    t1 = time.perf_counter()
+    for _ in range(blocks):
+        b"".join(inode.to_bytes() for inode in inodes)
+    results["encode"] = blocks*64/(time.perf_counter()-t1)
+    tracemalloc.start()
+    kept = [Inode.from_block(block, i*64) for i in range(blocks)]
+    results["bytes_per_inode"] = tracemalloc.get_traced_memory()[0]/(blocks*64)
+    tracemalloc.stop()
+    del kept
+    return results
 
 DEBUG = 0
+BITMAP_LEGACY = 0  # 1 bit per block in the first block_size/8 octets of each bitmap block (old volumes)
+BITMAP_DENSE = 1  # every bit of the bitmap blocks is used + free count summary blocks
+FULL_WORD = np.uint64(0xFFFFFFFFFFFFFFFF)
+INODE_VALID = 0x01
+INODE_DIRECTORY = 0x02  # data blocks are hash buckets of directory entries
+INODE_NESTED = 0x04  # entry of a sub directory (not in the root directory)
+INODE_INLINE = 0x08  # data stored in place of the pointers (INLINE_SIZE octets max)
+INODE_TAIL = 0x10  # data packed in a shared tail block: direct[0] block, direct[1] first unit
+INODE_COMPRESSED = 0x20  # data blocks: frame table then compressed frames
+INODE_FLAGS = INODE_VALID | INODE_DIRECTORY | INODE_NESTED | INODE_INLINE | INODE_TAIL | INODE_COMPRESSED
+INLINE_SIZE = 24
+TAIL_UNIT = 64  # tail blocks are shared by units of 64 octets, unit 0: occupancy bits (little endian uint64)
+FRAME_BLOCKS = 16  # uncompressed blocks of a frame of a compressed file (64Ko)
+FRAME_MAGIC = b"SFSZ"
+
+class FileReader(io.RawIOBase):
+    """Readable, seekable stream of a file (FileSystem.open(name, "rb")), reads go through read_at"""
+    def __init__(self, fs, inode:Inode):
+        super().__init__()
+        self.fs = fs
+        self.inode = inode
+        self.position = 0
+
+    def readable(self)->bool:
+        return True
+
+    def seekable(self)->bool:
+        return True
+
+    def readinto(self, buffer)->int:
+        data = self.fs.read_at(self.inode, self.position, len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset:int, whence:int=io.SEEK_SET)->int:
+        self.position = max(0, offset+(0, self.position, self.inode.size)[whence])
+        return self.position
+
+    def tell(self)->int:
+        return self.position
+
+
+class FileWriter(io.RawIOBase):
+    """Writable stream of a file (FileSystem.open(name, "wb"/"ab")):
+    - the size does not need to be known: full blocks are allocated as data comes (extents of growing size)
+      and go through a WritePipeline, the partial block stays in a buffer
+    - close writes the last block, the pointer blocks and the inode (size), then the metadata is committed
+    - "wb" on an existing file: the old blocks are freed on close, "ab": the last partial block is copied and written elsewhere
+    - a file of block_size/2 octets or less is stored inline or tail packed on close (FileSystem.store_small)
+    - codec: the data is compressed by frames of FRAME_BLOCKS blocks (frames failing the entropy probe,
+      or not saving a block, are stored as they are), the frame table is written on close
+    - an exception in a with block (or abort) frees the new blocks, the file stays as it was
+    """
+    def __init__(self, fs, path:str, inode:Inode, append:bool=False, codec=None):
+        super().__init__()
+        self.fs = fs
+        self.path = path
+        self.inode = inode
+        self.new = not inode.valid
+        self.pointers = []#data blocks, in order
+        self.allocated = []#every block taken by this stream
+        self.reserved = []#free blocks reserved ahead (next one last)
+        self.chunk = 8#blocks reserved at once, doubles up to max_chunk
+        self.max_chunk = fs.bits_per_bitmap_block
+        self.buffer = bytearray()
+        self.pending = []
+        self.old_blocks = []#freed on close
+        self.small = None#scratch inode holding the data of a small file until close
+        self.codec = codec
+        self.frame_size = FRAME_BLOCKS*fs.block_size
+        self.frames = []#(first block in self.pointers, compressed length (0: stored as is)) of each full frame
+        self.frames_size = 0#uncompressed octets in self.frames
+        if self.new:
+            fs.inode_used[inode.position] = True#slot kept until close/abort
+        elif append:
+            self.pointers = list(fs.data_pointers(inode))
+            data_blocks = set(self.pointers)
+            self.old_blocks = [block for block in fs.file_blocks(inode) if block not in data_blocks]#pointer blocks are written again
+            if inode.flags & INODE_COMPRESSED:#same codec, full frames are kept, the last partial one is decompressed
+                pointers = fs.file_pointers(inode)
+                self.codec, self.frame_size, table_blocks, entries = fs.frame_table(inode, pointers)
+                full = inode.size//self.frame_size
+                end = int(entries[full][0]) if full < len(entries) else len(self.pointers)
+                if full < len(entries):
+                    self.buffer += fs.read_frame(inode, full, pointers)
+                self.old_blocks += self.pointers[:table_blocks]+self.pointers[end:]
+                self.pointers = self.pointers[table_blocks:end]
+                self.frames = [(int(start)-table_blocks, int(length)) for start, length in entries[:full]]
+                self.frames_size = full*self.frame_size
+            elif self.pointers:#uncompressed data blocks: the file keeps its format, appended data is not compressed
+                self.codec = None
+                if inode.size%fs.block_size:#copy of the last partial block
+                    last = self.pointers.pop()
+                    self.buffer += bytes(fs.read_sector(last)).ljust(fs.block_size, b"\x00")[:inode.size%fs.block_size]
+                    self.old_blocks.append(last)
+            if inode.is_small():
+                self.buffer += fs.read_small(inode)
+        else:
+            self.old_blocks = fs.file_blocks(inode)
+        self.pipeline = WritePipeline(fs.encrypt_pairs, fs.disk.write_many)
+
+    def writable(self)->bool:
+        return True
+
+    def allocate(self)->int:
+        if not self.reserved:
+            extents = self.fs.allocate_extents(self.chunk)
+            if extents is None:
+                block = self.fs.find_free_data_block()
+                if block is None:
+                    raise OSError("No free data block left")
+                extents = [(block, 1)]
+            self.reserved = [block for start, length in extents for block in range(start, start+length)][::-1]
+            self.allocated += self.reserved
+            self.chunk = min(self.chunk*2, self.max_chunk)
+        return self.reserved.pop()
+
+    def write_block(self, data:bytes)->int:
+        block = self.allocate()
+        self.fs.queue_sector(self.pending, block, data, self.pipeline)
+        return block
+
+    def write(self, data)->int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.buffer += data
+        if self.codec is not None:
+            if self.frames_size+len(self.buffer) > self.fs.block_size*(4+1024+1024*1024):
+                raise OSError("File too big")
+            full = len(self.buffer)//self.frame_size
+            for i in range(full):
+                self.write_frame(bytes(self.buffer[i*self.frame_size:(i+1)*self.frame_size]))
+            del self.buffer[:full*self.frame_size]
+            return len(data)
+        full = len(self.buffer)//self.fs.block_size
+        if len(self.pointers)+full > 4+1024+1024*1024:
+            raise OSError("File too big")
+        for i in range(full):
+            self.pointers.append(self.write_block(bytes(self.buffer[i*self.fs.block_size:(i+1)*self.fs.block_size])))
+        del self.buffer[:full*self.fs.block_size]
+        return len(data)
+
+    def write_frame(self, frame:bytes):
+        """Compress a frame (unless the probe says it would not shrink) and write its blocks"""
+        bs = self.fs.block_size
+        data, length = frame, 0
+        if compressible(frame):
+            compressed = self.codec.compress(frame)
+            if -(-len(compressed)//bs) < -(-len(frame)//bs):#at least one block saved
+                data, length = compressed, len(compressed)
+        self.frames.append((len(self.pointers), length))
+        self.frames_size += len(frame)
+        for i in range(0, len(data), bs):
+            self.pointers.append(self.write_block(data[i:i+bs]))
+
+    def frame_table(self)->list:
+        """Write the frame table (header, then first block and compressed length of each frame), its blocks come first in the file"""
+        bs = self.fs.block_size
+        table_blocks = -(-(8+8*len(self.frames))//bs)
+        table = FRAME_MAGIC+bytes([self.codec.codec_id, self.frame_size//bs, 0, 0])
+        table += np.array([(start+table_blocks, length) for start, length in self.frames], dtype=">u4").tobytes()
+        return [self.write_block(table[i:i+bs]) for i in range(0, len(table), bs)]
+
+    def pointer_block(self, pointers:list)->int:
+        return self.write_block(np.array(pointers, dtype=">u4").tobytes())
+
+    def close(self):
+        if self.closed:
+            return
+        fs = self.fs
+        try:
+            size = len(self.pointers)*fs.block_size+len(self.buffer)
+            if self.codec is not None:
+                size = self.frames_size+len(self.buffer)
+            if not self.pointers and self.buffer:
+                small = Inode(b"\x00", self.inode.position)
+                if fs.store_small(small, bytes(self.buffer)):
+                    self.small = small
+            if self.buffer and self.small is None and self.codec is not None:
+                self.write_frame(bytes(self.buffer))
+            elif self.buffer and self.small is None:
+                self.pointers.append(self.write_block(bytes(self.buffer)))
+            compressed = self.small is None and self.codec is not None and size > 0
+            if compressed:
+                self.pointers = self.frame_table()+self.pointers
+            per_block = fs.block_size//4
+            rest = self.pointers[4:]
+            indirect = self.pointer_block(rest[:per_block]) if rest else 0
+            rest = rest[per_block:]
+            double_indirect = 0
+            if rest:
+                double_indirect = self.pointer_block([self.pointer_block(rest[i:i+per_block]) for i in range(0, len(rest), per_block)])
+            if self.pending:
+                fs.discard_blocks([sector for sector, _ in self.pending])
+                self.pipeline.submit(self.pending)
+            self.pipeline.close()
+            located = fs.locate(self.path)
+            if located is None or (located[2] is not None) == self.new:
+                raise OSError(f"{self.path} changed while being written")
+        except BaseException:
+            self.abort()
+            raise
+        fs.free_blocks(self.reserved)
+        inode = self.inode if self.new else located[2]
+        fs.free_small(inode)#old small data (copied in the buffer by "ab")
+        inode.flags = (inode.flags & ~INODE_COMPRESSED) | (INODE_COMPRESSED if compressed else 0)
+        inode.valid = True
+        inode.size = size
+        inode.direct = (self.pointers[:4]+[0]*4)[:4]
+        inode.indirect, inode.double_indirect = indirect, double_indirect
+        if self.small is not None:
+            inode.flags |= self.small.flags & (INODE_INLINE | INODE_TAIL)
+            inode.direct, inode.indirect, inode.double_indirect = self.small.direct, self.small.indirect, self.small.double_indirect
+        fs.pointer_cache.pop(inode.position, None)
+        if self.new:
+            if not fs.link(located[0], located[1], inode):
+                self.abort()
+                raise OSError(f"Cannot add {self.path} to its directory")
+            fs.add_inode(inode)
+            fs.update_superblock()
+        else:
+            fs.update_node(inode)
+        fs.free_blocks(self.old_blocks)
+        fs.save_bitmap()
+        super().close()
+
+    def abort(self):
+        """Forget what was written: new blocks freed, the file is not changed"""
+        if self.closed:
+            return
+        self.pipeline.cancel()
+        self.fs.free_blocks(self.allocated)
+        if self.small is not None:
+            self.fs.free_small(self.small)
+        if self.new:
+            self.fs.inode_used[self.inode.position] = False
+            self.fs.next_free_inode = min(self.fs.next_free_inode, self.inode.position)
+        self.fs.flush()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
 
 class FileSystem:
     """Filesystem class to handle file operations
     block_size: 4ko (8*512 (8*sector_size))
     inode: 64 octets (each pointer is 4 octets)
-        - valid (1 octet)
+        - valid + flags (1 octet: 1 valid, 2 directory, 4 nested, 8 inline, 16 tail, 32 compressed)
         - size (7 octets)
         - name # 32 octets
         - Direct[0] (points to Data block)
@@ -66,64 +419,476 @@ class FileSystem:
     
     block_bitmap: 1 bit per block (1: used, 0: free)
 
+    bitmap summary: free blocks of each bitmap block + 1 (2 octets, 0: unknown, counted when the bitmap block is loaded)
+
     Superblock: (each part is 4 octets)
         - magic number
         - number of block_bitmap blocks
         - number of inode blocks
         - number of inodes in inode blocks
+        - cipher id (1 octet, 0: SectorCrypt, 1: AES-XTS)
+        - bitmap layout (1 octet, 0: legacy, 1: dense + summary)
+        - inode blocks in use + 1 (0: unknown, every inode block is read at mount)
+        - directory index first block, number of blocks (0: no index)
+        - journal blocks (0: no journal, volumes created before it)
+
+    directory index (written on close, dropped at the first inode change):
+        - magic number "SFSI", number of inodes (4 octets)
+        - slot number (4 octets) + inode (64 octets) for each file of the root directory
+        - used inode slots (1 bit per slot, nested inodes included)
+        - number of tail blocks with free units (4 octets), then block (4 octets) + free units (1 octet) for each
+
+    directories:
+        - root: inodes without the nested flag, kept in self.directory (names: 32 octets max)
+        - sub directory: directory inode, its data blocks are hash buckets (power of 2, crc32(name) % buckets)
+        - bucket entry: inode slot + 1 (4 octets, 0: end of bucket), name length (1 octet), name (255 octets max)
+        - a full bucket doubles the number of buckets (every entry is hashed again)
+
+    small files (no pointer block, no data block of their own):
+        - inline: INLINE_SIZE (24) octets max, the data replaces Direct[0..3], Indirect and Double Indirect
+        - tail: block_size/2 octets max, packed with other small files in a tail block:
+          Direct[0]: tail block, Direct[1]: first unit (TAIL_UNIT octets each)
+        - tail block: unit 0 holds the occupancy bits of the units (1: used), freed when its last file is deleted
+        - tail blocks go through the cache (and the journal) like metadata
+
+    compressed files (compressed flag, data compressed before encryption):
+        - the data is cut in frames of FRAME_BLOCKS blocks compressed one by one, each frame starts on a new block
+        - the first data blocks are the frame table: magic number "SFSZ", codec id (1 octet), frame blocks (1 octet),
+          2 octets unused, then for each frame: first block (4 octets, index in the data blocks), compressed length (4 octets, 0: not compressed)
+        - reading a range only reads and decompresses the frames covering it (see read_frame)
 
     sector structure:
         - 1st sector: superblock
         - 2nd to free_block/32768: block_bitmap blocks
-        - free_block/32768 to number_of_inode_blocks: inode blocks
+        - bitmap summary blocks (dense layout only)
+        - then number_of_inode_blocks: inode blocks
+        - journal blocks
         - rest of the blocks: data blocks
 
+    journal (metadata blocks: superblock, bitmap, summary, inode and directory blocks):
+        - 1st block: magic number "SFSJ", sequence of the first transaction (8 octets)
+        - transactions one after the other: descriptor (magic "SFSD", sequence (8), count (4), block numbers (4 each)),
+          count blocks, commit block (magic "SFSC", sequence (8), crc32 of block numbers + blocks (4))
+        - committed blocks are written in place at the next checkpoint (journal full, checkpoint_interval or close),
+          valid transactions are replayed at mount
+
     """
     magic_number = b"\x53\x46\x53\x45"  # SFSE # Super FileSystem Explorer
+    index_magic_number = b"SFSI"
+    journal_magic_number = b"SFSJ"
+    descriptor_magic_number = b"SFSD"
+    commit_magic_number = b"SFSC"
 
-    def __init__(self,skip:int,passwd=None,pin= None):
-        """Explorer class to handle disk and crypt"""
-        with open("config.ini", "r") as f:
-            serial = f.readline().strip().split("=")[1]
-        self.disk = Disk(serial, skip)
-        passwd = input("Enter password: ") if passwd is None else passwd
-        pin = input("Enter PIN: ") if pin is None else pin
-        self.crypt_module = SectorCrypt(passwd, pin)
+    def __init__(self,skip:int,passwd=None,pin= None,workers:int=0,chunk_size:int=64,max_in_flight:int=64*1024**2,cipher:str="sectorcrypt",use_agent:bool=True,image:str=None,direct:bool=False,use_mmap:bool=False,cache_size:int=32*1024**2,pin_metadata:bool=True,readahead:int=256,directory_index:bool=False,journal:bool=True,group_commit:int=1,checkpoint_interval:float=30,small_files:bool=True,compression:str=None):
+        """Explorer class to handle disk and crypt
+        - cipher: cipher of new volumes ("sectorcrypt" or "xts"), existing volumes use the one in their superblock
+        - use_agent: get/store the unlocked master key from/in the unlock agent (agent.py)
+        - image: mount an image file / block device (linux) instead of the drive in config.ini ("image=path" in config.ini works too)
+        - direct: open the image with O_DIRECT
+        - use_mmap: map the image in memory (zero copy reads, msync at commit points)
+        - cache_size: budget of the decrypted block cache (octets)
+        - pin_metadata: keep superblock, bitmap and inode blocks in the cache once read
+        - readahead: max blocks prefetched at once by read_file on a background thread (0: no read-ahead)
+        - directory_index: save the inodes in a directory index on close, next mounts read it instead of the inode blocks
+        - journal: new volumes reserve a metadata journal (metadata changes are committed to it, replayed at mount)
+        - group_commit: operations (create, delete...) committed together in one journal write
+        - checkpoint_interval: seconds before the committed blocks are written in place (or when the journal is full)
+        - small_files: new files of INLINE_SIZE octets or less are stored in their inode, files of block_size/2 octets
+          or less are packed in shared tail blocks (older versions skip these inodes)
+        - compression: codec of the new files ("zlib", "lzma", see compress.CODECS), None: not compressed
+          (open/create_file/create_files can choose another one for a file)
+        - workers: if > 0, encrypt/decrypt batches in a pool of worker processes
+        - chunk_size: sectors sent to a worker at once
+        - max_in_flight: max bytes waiting in the pool
+        """
+        if image is None:
+            with open("config.ini", "r") as f:
+                key, serial = f.readline().strip().split("=", 1)
+            if key == "image":
+                image = serial
+        if image is not None and use_mmap:
+            self.disk = MmapDisk(image, skip)
+        elif image is not None:
+            self.disk = ImageDisk(image, skip, direct=direct)
+        else:
+            self.disk = Disk(serial, skip)
+        if cipher not in CIPHERS:
+            raise ValueError(f"Unknown cipher: {cipher}")
+        self.cipher = cipher
         self.mode = "crypt"
         self.number_of_inode_blocks = 0
         self.block_size = 4096# NEED TO BE CONGRUENT TO SECTOR SIZE !!!
+        self.use_agent = use_agent
+        self.cache = BlockCache(self.write_back, cache_size)
+        self.header_block = self.disk.number_of_sectors//(self.block_size//self.disk.sector_size)-1#last block: key slots
+        self.keyslots = self.read_keyslots()
+        self.credentials = None#only kept until a new volume has its key slots
+        if self.keyslots is not None:
+            self.crypt_module = self.unlock(passwd, pin)
+        else:
+            passwd, pin = self.ask_credentials(passwd, pin)
+            self.crypt_module = SectorCrypt(passwd, pin)#volumes without key slots: the derived key is the data key
+            self.credentials = (passwd, pin)
+        self.batch_size = 256#blocks per batch for read_sectors/write_sectors (1Mo)
+        self.readahead = readahead
+        self.parallel = None
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        if workers > 0:
+            self.batch_size = max(self.batch_size, 2*workers*chunk_size)#enough blocks to feed every worker
+        self.directory_index = directory_index
+        self.pointer_cache = OrderedDict()#inode slot: decoded pointer blocks (read_range)
+        self.pointer_cache_files = 64
+        self.small_files = small_files
+        self.tail_blocks = OrderedDict()#tail block: free units (rebuilt at mount from the inodes or the index, most recent last)
+        self.compression = self.codec(compression)
+        self.journal = journal
+        self.group_commit = group_commit
+        self.checkpoint_interval = checkpoint_interval
+        self.journal_ready = False#metadata goes through the journal once it is opened
+        self.checkpoint_pending = {}#block: committed data not written in place yet
+        self.pending_operations = 0
+        self.blocks_freed = False
+        mount_start = time.perf_counter()
         self.init_fs()
-        # self.bitmap = self.read_bitmap()#very slow way of loading everything
-        self.bitmap = {}
-        self.hot_bitmap_blocks = {}#edit bitmap blocks in memory to avoid writing to disk multiple times
-        self.directory = self.read_inodes()
+        self.credentials = None
+        self.setup_cipher()
+        if self.open_journal():#replayed transactions: the superblock may have changed
+            self.init_fs()
+        if pin_metadata:
+            self.cache.pin(range(self.offset_data))
+        self.load_summary()
+        self.directory = self.read_index()
+        if self.directory is None:
+            self.directory = self.read_inodes()
+        self.mount_time = time.perf_counter()-mount_start#seconds (after the key is unlocked)
+        if DEBUG:print(f"[*] Mounted in {self.mount_time*1000:.1f} ms")
 
         
     def read_sector(self, sector:int):
+        """Read (and decrypt) a sector, the block is cached"""
+        cached = self.cache.get(sector)
+        if cached is not None:
+            return cached
+        cached = self.checkpoint_pending.get(sector)#committed, not written in place yet
+        if cached is not None:
+            self.cache.put(sector, cached)
+            return cached
         if DEBUG:print(f"Reading sector {sector}")
         sector_data = self.disk.read_sector(sector,self.block_size)
         if self.mode == "crypt":
             if sector_data is None or not any(sector_data):
-                return b""
-            decrypted_sector = self.crypt_module.decrypt_sector(sector, sector_data)
-            return decrypted_sector
-        else:
-            return sector_data
+                sector_data = b""
+            else:
+                sector_data = self.crypt_module.decrypt_sector(sector, sector_data)
+        elif sector_data is not None:
+            sector_data = bytes(sector_data)
+        if sector_data is not None:
+            self.cache.put(sector, sector_data)
+        return sector_data
 
     def write_sector(self, sector:int, data:bytes):
         """Write data to sector
         - If data is less than sector size, it will be padded with null bytes
         - /!\ Warning: Data must be less than sector size
         - /!\ Sector will be overwritten
+        - the block stays dirty in the cache until the next flush (or its eviction)
         """
         if DEBUG:print(f"Writing to sector {sector}")
-        if self.mode == "crypt":
-            encrypted_sector = self.crypt_module.encrypt_sector(sector, data.ljust(self.block_size, b"\x00"))
-            self.disk.write_sector(sector, encrypted_sector)
+        self.cache.put(sector, bytes(data).ljust(self.block_size, b"\x00"), dirty=True)
+        return 1
+
+    def mutable_sector(self, sector:int)->bytearray:
+        """Cached block that can be modified in place (call self.cache.mark_dirty after)"""
+        data = self.read_sector(sector)
+        if not isinstance(data, bytearray):
+            data = bytearray(data.ljust(self.block_size, b"\x00"))
+            self.cache.put(sector, data)
+        return data
+
+    def flush(self):
+        """Commit point: write the dirty blocks (one journal transaction) and flush the disk"""
+        self.cache.flush()
+        self.disk.flush()
+        self.pending_operations = 0
+        self.blocks_freed = False
+        if self.journal_ready and time.monotonic()-self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def open_journal(self)->bool:
+        """Replay the valid transactions of the journal (unclean unmount), True if blocks were written in place"""
+        self.journal_ready = False
+        self.checkpoint_pending = {}
+        if self.journal_blocks == 0:
+            return False
+        header = bytes(self.read_sectors([self.offset_journal])[0])
+        if header[:4] != self.journal_magic_number:
+            print("[-] Invalid journal, reset")
+            self.reset_journal(int.from_bytes(os.urandom(4), byteorder="big"))
+            header = self.journal_magic_number+self.journal_sequence.to_bytes(8, byteorder="big")
+        sequence = int.from_bytes(header[4:12], byteorder="big")
+        per_descriptor = (self.block_size-16)//4
+        position = 1
+        replay = {}
+        while position+2 <= self.journal_blocks:
+            descriptor = bytes(self.read_sectors([self.offset_journal+position])[0])
+            count = int.from_bytes(descriptor[12:16], byteorder="big")
+            if (descriptor[:4] != self.descriptor_magic_number or int.from_bytes(descriptor[4:12], byteorder="big") != sequence
+                    or count > per_descriptor or position+count+2 > self.journal_blocks):
+                break
+            first = self.offset_journal+position+1
+            transaction = [bytes(block).ljust(self.block_size, b"\x00") for block in self.read_sectors(list(range(first, first+count+1)))]
+            blocks = descriptor[16:16+4*count]
+            checksum = zlib.crc32(b"".join(transaction[:count]), zlib.crc32(blocks))
+            if transaction[count][:16] != self.commit_magic_number+descriptor[4:12]+checksum.to_bytes(4, byteorder="big"):
+                break#not committed (crash while writing it)
+            for i in range(count):
+                replay[int.from_bytes(blocks[4*i:4*i+4], byteorder="big")] = transaction[i]
+            position += count+2
+            sequence += 1
+        if position > 1:
+            print(f"[*] Journal: {len(replay)} blocks replayed")
+            self.write_through(sorted(replay.items()))
+            self.cache.discard(list(replay))
+            self.disk.flush()
+            self.reset_journal(sequence)
         else:
-            self.disk.write_sector(sector, data.ljust(self.block_size, b"\x00"))
+            self.journal_sequence, self.journal_head = sequence, 1
+        self.disk.flush()
+        self.journal_ready = True
+        self.last_checkpoint = time.monotonic()
+        return position > 1
+
+    def reset_journal(self, sequence:int):
+        """Empty journal: header with the sequence of the next transaction"""
+        self.journal_sequence = sequence
+        self.journal_head = 1
+        self.write_through([(self.offset_journal, self.journal_magic_number+sequence.to_bytes(8, byteorder="big"))])
+
+    def commit_transaction(self, pairs:list):
+        """Write (block, data) pairs as one transaction in the journal (one sequential write),
+        they are written in place at the next checkpoint
+        - more blocks than a transaction holds (journal or descriptor full): several transactions,
+          a crash between them is not atomic (a warning is printed)
+        """
+        pairs = [(block, bytes(data).ljust(self.block_size, b"\x00")) for block, data in pairs]#copies: cached blocks change in place
+        largest = min(self.journal_blocks-3, (self.block_size-16)//4)#header, descriptor and commit block apart
+        if len(pairs) > largest:
+            print(f"[!] {len(pairs)} metadata blocks do not fit in one journal transaction ({largest} blocks): "
+                  f"committed in {-(-len(pairs)//largest)} transactions, not atomic")
+            for i in range(0, len(pairs), largest):
+                self.commit_transaction(pairs[i:i+largest])
+            return 1
+        if self.journal_head+len(pairs)+2 > self.journal_blocks:
+            self.checkpoint()
+        blocks = b"".join(block.to_bytes(4, byteorder="big") for block, _ in pairs)
+        checksum = zlib.crc32(b"".join(data for _, data in pairs), zlib.crc32(blocks))
+        sequence = self.journal_sequence.to_bytes(8, byteorder="big")
+        start = self.offset_journal+self.journal_head
+        transaction = [(start, self.descriptor_magic_number+sequence+len(pairs).to_bytes(4, byteorder="big")+blocks)]
+        transaction += [(start+1+i, data) for i, (_, data) in enumerate(pairs)]
+        transaction.append((start+1+len(pairs), self.commit_magic_number+sequence+checksum.to_bytes(4, byteorder="big")))
+        self.write_through(transaction)
+        self.journal_head += len(pairs)+2
+        self.journal_sequence += 1
+        self.checkpoint_pending.update(pairs)
+        return 1
+
+    def checkpoint(self):
+        """Write the committed blocks in place (sorted, one write for each contiguous run), then empty the journal"""
+        self.last_checkpoint = time.monotonic()
+        if not self.checkpoint_pending and self.journal_head == 1:
+            return
+        self.disk.flush()#the transactions are on disk before their blocks are overwritten
+        if self.checkpoint_pending:
+            self.write_through(sorted(self.checkpoint_pending.items()))
+            self.disk.flush()
+        self.checkpoint_pending = {}
+        self.reset_journal(self.journal_sequence)
+        self.disk.flush()
+
+    def read_sectors(self, sectors:list)->list:
+        """Read many sectors, contiguous runs are decrypted in one call
+        - returns a list of blocks (same as read_sector for each sector)
+        """
+        if DEBUG:print(f"Reading sectors {sectors}")
+        result = [self.cache.get(sector) for sector in sectors]
+        if self.checkpoint_pending:
+            result = [self.checkpoint_pending.get(sector) if data is None else data for sector, data in zip(sectors, result)]
+        missing = [i for i in range(len(sectors)) if result[i] is None]
+        raw_sectors = self.disk.read_many([sectors[i] for i in missing], self.block_size)
+        if self.mode != "crypt":
+            for i, raw_sector in zip(missing, raw_sectors):
+                result[i] = bytes(raw_sector)
+            return result
+        to_decrypt = [(i, raw_sector) for i, raw_sector in zip(missing, raw_sectors) if raw_sector is not None and any(raw_sector)]
+        decrypted = self.crypt_engine(len(to_decrypt)).decrypt_sectors([(sectors[i], raw_sector) for i, raw_sector in to_decrypt])
+        for i in missing:
+            result[i] = b""
+        for (i, _), data in zip(to_decrypt, decrypted):
+            result[i] = data
+        return result
+
+    def write_sectors(self, pairs:list):
+        """Write many (sector, data) pairs, contiguous runs are encrypted in one call
+        - same padding rules as write_sector
+        - written directly (data blocks), cached copies are dropped
+        """
+        self.discard_blocks([sector for sector, _ in pairs])
+        return self.write_through(pairs)
+
+    def discard_blocks(self, blocks:list):
+        """Blocks about to be written directly: cached copies are dropped,
+        a reused block with committed metadata is written in place first (checkpoint) so a replay cannot overwrite it"""
+        self.cache.discard(blocks)
+        if self.checkpoint_pending and not self.checkpoint_pending.keys().isdisjoint(blocks):
+            self.checkpoint()
+
+    def write_back(self, pairs:list):
+        """Cache write back of dirty metadata blocks: one journal transaction once the journal is open, else written in place"""
+        if not self.journal_ready:
+            return self.write_through(pairs)
+        return self.commit_transaction(pairs)
+
+    def write_through(self, pairs:list):
+        """Encrypt and write (sector, data) pairs to the disk"""
+        self.disk.write_many(self.encrypt_pairs(pairs))
         return 1
 
+    def encrypt_pairs(self, pairs:list)->list:
+        """Pad and encrypt (sector, data) pairs, ready for disk.write_many"""
+        if DEBUG:print(f"Writing to sectors {[sector for sector, _ in pairs]}")
+        pairs = [(sector, bytes(data).ljust(self.block_size, b"\x00")) for sector, data in pairs]
+        if self.mode == "crypt":
+            pairs = list(zip([sector for sector, _ in pairs], self.crypt_engine(len(pairs)).encrypt_sectors(pairs)))
+        return pairs
+
+    def crypt_engine(self, count:int):
+        """Process pool for big batches, local cipher for small ones"""
+        if self.parallel is not None and count > self.parallel.chunk_size:
+            return self.parallel
+        return self.crypt_module
+
+    def ask_credentials(self, passwd=None, pin=None):
+        ask = input if sys.stdin.isatty() else getpass.getpass#stdin can be the data of a pipe (put/append)
+        passwd = ask("Enter password: ") if passwd is None else passwd
+        pin = ask("Enter PIN: ") if pin is None else pin
+        return passwd, pin
+
+    def read_keyslots(self)->KeySlots:
+        """Read the key slots header (in clear), None for volumes without it"""
+        data = self.disk.read_sector(self.header_block, self.block_size)
+        if not KeySlots.is_header(data):
+            return None
+        return KeySlots(bytes(data))
+
+    def write_keyslots(self):
+        self.disk.write_sector(self.header_block, self.keyslots.to_bytes().ljust(self.block_size, b"\x00"))
+
+    def unlock(self, passwd=None, pin=None)->SectorCrypt:
+        """Get the master key from the agent, or from a key slot (Argon2)"""
+        master_key = agent.get_key(self.keyslots.volume_id) if self.use_agent else None
+        if master_key is None:
+            passwd, pin = self.ask_credentials(passwd, pin)
+            master_key, _ = self.keyslots.unlock(passwd, pin)
+            if self.use_agent:
+                agent.put_key(self.keyslots.volume_id, master_key)
+        return SectorCrypt.from_key(master_key, KeySlots.volume_pin(master_key))
+
+    def create_keyslots(self):
+        """New volume: random master key wrapped with the password/PIN in slot 0"""
+        self.keyslots, master_key = KeySlots.create(*self.credentials)
+        self.write_keyslots()
+        self.crypt_module = SectorCrypt.from_key(master_key, KeySlots.volume_pin(master_key))
+        if self.use_agent:
+            agent.put_key(self.keyslots.volume_id, master_key)
+
+    def add_passphrase(self, passwd:str, pin:str)->int:
+        """Add a password/PIN to the volume, returns the key slot number"""
+        if self.keyslots is None:
+            raise Exception("This volume has no key slots (created before them), its password cannot change")
+        index = self.keyslots.add(self.crypt_module.password, passwd, pin)
+        self.write_keyslots()
+        return index
+
+    def remove_passphrase(self, index:int):
+        """Remove a key slot"""
+        if self.keyslots is None:
+            raise Exception("This volume has no key slots (created before them), its password cannot change")
+        self.keyslots.remove(index)
+        self.write_keyslots()
+
+    def change_passphrase(self, old_passwd:str, old_pin:str, passwd:str, pin:str):
+        """Replace a password/PIN, only the key slots block is rewritten"""
+        if self.keyslots is None:
+            raise Exception("This volume has no key slots (created before them), its password cannot change")
+        _, index = self.keyslots.unlock(old_passwd, old_pin)
+        self.keyslots.slots[index] = None
+        self.keyslots.add(self.crypt_module.password, passwd, pin)
+        self.write_keyslots()
+
+    def setup_cipher(self):
+        """Once the cipher of the volume is known:
+        - hint the hot metadata blocks (superblock, bitmap and inode blocks)
+        - start the worker processes
+        """
+        self.crypt_module.pin_sectors(range(self.offset_data))
+        self.stop_workers()
+        if self.workers > 0:
+            self.parallel = ParallelCrypt(self.crypt_module, self.workers, self.chunk_size, self.max_in_flight)
+
+    def mount_cipher(self)->bytes:
+        """Find the cipher of the volume:
+        - decrypt the superblock with every known cipher until magic number and cipher id match
+        - return the decrypted superblock (without magic number if the volume is not initialized)
+        """
+        original = self.crypt_module
+        key, pin = original.password, original.pin
+        candidates = [
+            SectorCrypt.from_key(key, pin),
+            SectorCrypt.from_key(key, pin, noise_version=NOISE_LEGACY),#volumes created before the CTR keystream
+            XTSCrypt.from_key(key, pin),
+        ]
+        for crypt in candidates:
+            self.crypt_module = crypt
+            self.cache.clear()#don't keep a block decrypted with the wrong cipher
+            superblock = self.read_sector(0)
+            cipher_id = superblock[16] if len(superblock) > 16 else 0
+            if superblock[:4] == self.magic_number and cipher_id == crypt.cipher_id:
+                return superblock
+        self.crypt_module = original
+        self.cache.clear()
+        return superblock
+
+    def stop_workers(self):
+        """Release the worker processes"""
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
+
+    def close(self):
+        """Unmount: write the directory index, write back the cache, release the worker processes and the disk"""
+        if self.directory_index and self.index_start == 0:
+            self.write_index()
+        self.flush()
+        if self.journal_ready:
+            self.checkpoint()#clean journal: nothing to replay at the next mount
+        self.stop_workers()
+        self.disk.close()
+
+    def queue_sector(self, pending:list, sector:int, data:bytes, pipeline:WritePipeline=None):
+        """Add a block to a pending write batch, flush it when batch_size is reached
+        (to the write pipeline if given, else written now)"""
+        pending.append((sector, data))
+        if len(pending) >= self.batch_size:
+            if pipeline is None:
+                self.write_sectors(pending)
+            else:
+                self.discard_blocks([sector for sector, _ in pending])
+                pipeline.submit(pending)
+            pending.clear()
+
     def init_fs(self,force=False):
         """Initialize filesystem:
             - magic number
@@ -131,376 +896,1520 @@ class FileSystem:
             - number of inode blocks
             - number of inodes in inode blocks
         """
-        superblock = self.read_sector(0)
+        superblock = self.mount_cipher() if self.mode == "crypt" and not force else self.read_sector(0)
+        if superblock[:4] != self.magic_number and self.keyslots is None and self.credentials is not None:
+            self.create_keyslots()#new volume
         self.number_of_blocks = self.disk.number_of_sectors//(self.block_size//self.disk.sector_size)
+        if self.keyslots is not None:
+            self.number_of_blocks -= 1#last block: key slots
         self.number_of_inode_blocks = round((self.number_of_blocks-1)/100_000)#.001% of disk size (1 inode block per 1000 sectors)
+        mounted = superblock[:4] == self.magic_number and not force
+        self.bitmap_version = (superblock[17] if len(superblock) > 17 else BITMAP_LEGACY) if mounted else BITMAP_DENSE
         #self.disk.block_size*8 => number of bits in a block
-        self.number_of_bitmap_blocks = (self.number_of_blocks-self.number_of_inode_blocks-1)//(self.block_size*8)#num of blocks - superblock - inode blocks (free space)
-        self.offset_data = self.number_of_bitmap_blocks + self.number_of_inode_blocks + 1
-        if superblock[:4] == self.magic_number and not force:return
+        if mounted:#layout of the volume (volumes created before rounded down)
+            self.number_of_bitmap_blocks = int.from_bytes(superblock[4:8], byteorder="big")
+        else:#rounded up: the last bitmap block is partial (bitmap_bits), every data block can be allocated
+            self.number_of_bitmap_blocks = -(-(self.number_of_blocks-self.number_of_inode_blocks-1)//(self.block_size*8))#num of blocks - superblock - inode blocks (free space)
+        if self.bitmap_version == BITMAP_DENSE:
+            self.bits_per_bitmap_block = self.block_size*8
+            self.number_of_summary_blocks = -(-self.number_of_bitmap_blocks*2//self.block_size)
+        else:
+            self.bits_per_bitmap_block = self.block_size#only the first block_size/8 octets of each bitmap block
+            self.number_of_summary_blocks = 0
+        self.offset_summary = self.number_of_bitmap_blocks + 1
+        self.offset_inodes = self.offset_summary + self.number_of_summary_blocks
+        self.offset_journal = self.offset_inodes + self.number_of_inode_blocks
+        if mounted:
+            self.journal_blocks = int.from_bytes(superblock[30:34], byteorder="big")
+        else:
+            self.journal_blocks = max(32, min(1024, self.number_of_blocks//1000)) if self.journal else 0
+        self.offset_data = self.offset_journal + self.journal_blocks
+        self.inode_blocks_used = int.from_bytes(superblock[18:22], byteorder="big")-1 if mounted else 0
+        self.index_start = int.from_bytes(superblock[22:26], byteorder="big") if mounted else 0
+        self.index_blocks = int.from_bytes(superblock[26:30], byteorder="big") if mounted else 0
+        self.bitmap_capacity = np.array([self.bitmap_bits(n) for n in range(1, self.offset_summary)], dtype=np.int32)
+        if mounted:return
         print("[*] Initializing filesystem...")
+        self.crypt_module = CIPHERS[self.cipher].from_key(self.crypt_module.password, self.crypt_module.pin)
         superblock = self.magic_number
         superblock += self.number_of_bitmap_blocks.to_bytes(4, byteorder="big")
         superblock += self.number_of_inode_blocks.to_bytes(4, byteorder="big")
         superblock += b"\x00\x00\x00\x00"#none for now
+        superblock += self.crypt_module.cipher_id.to_bytes(1, byteorder="big")
+        superblock += self.bitmap_version.to_bytes(1, byteorder="big")
+        superblock += (self.inode_blocks_used+1).to_bytes(4, byteorder="big")
+        superblock += b"\x00"*8#no directory index
+        superblock += self.journal_blocks.to_bytes(4, byteorder="big")
         self.write_sector(0, superblock)
-        # Create bitmap + inode blocks
-        if not force:#already done
-            for blockpos in range(1, self.offset_data):
-                self.write_sector(blockpos, b"\x00"*self.block_size)
-                #print(f"[*] {blockpos}/{self.offset_data} ({round(blockpos/self.offset_data*100)}%)", end="\r")
+        # Create bitmap + summary + inode blocks
+        for blockpos in range(1, self.offset_journal):
+            self.write_sector(blockpos, b"\x00"*self.block_size)
+            #print(f"[*] {blockpos}/{self.offset_data} ({round(blockpos/self.offset_data*100)}%)", end="\r")
+        self.free_counts = self.bitmap_capacity.copy()
+        for number in range(1, self.offset_summary, self.block_size//2):
+            self.save_summary(number, self.block_size//2)
+        if self.journal_blocks:
+            self.reset_journal(int.from_bytes(os.urandom(4), byteorder="big"))#random: old transactions of a reset volume never match
+        self.flush()
         return
     
     def update_superblock(self):
         """Update superblock:
             - number of inodes in inode Block
+            - inode blocks in use, directory index
         """
-        superblock = self.read_sector(0)
-        superblock = superblock[:12]#skip magic number + number of bitmap blocks + number of inode blocks
-        superblock += len(self.directory).to_bytes(4, byteorder="big")
+        superblock = bytes(self.read_sector(0)).ljust(30, b"\x00")
+        superblock = (superblock[:12] + len(self.directory).to_bytes(4, byteorder="big") + superblock[16:18]#keep cipher id, bitmap layout
+                      + (self.inode_blocks_used+1).to_bytes(4, byteorder="big")
+                      + self.index_start.to_bytes(4, byteorder="big") + self.index_blocks.to_bytes(4, byteorder="big") + superblock[30:])
         self.write_sector(0, superblock)
         return
     
-    def load_bitmap(self,block_number:int):
-        """Load bitmap for a specific block"""
-        bitmap_block = self.read_sector(block_number)
-        self.hot_bitmap_blocks[block_number] = bitmap_block
-        for byte_number in range(self.block_size):
-            for bit_number in range(8):
-                if bitmap_block[byte_number] & (1<<bit_number):
-                    self.bitmap[self.offset_data+(block_number-1)*self.block_size+byte_number*8+bit_number] = 1
-        return
-    
+    def load_summary(self):
+        """Free blocks of each bitmap block (from the summary blocks, -1: unknown until the bitmap block is loaded)"""
+        self.free_counts = np.full(self.number_of_bitmap_blocks, -1, dtype=np.int32)
+        self.next_bitmap_block = 1#allocation goes on where it stopped
+        self.next_free_bit = 0
+        self.free_extents = {}#bitmap block number: (starts, lengths) of its free runs
+        if self.number_of_summary_blocks == 0:
+            return
+        summary = b"".join(bytes(self.read_sector(block)).ljust(self.block_size, b"\x00") for block in range(self.offset_summary, self.offset_inodes))
+        self.free_counts[:] = np.frombuffer(summary, dtype="<u2")[:self.number_of_bitmap_blocks].astype(np.int32)-1
+
+    def save_summary(self, bitmap_block_number:int, count:int=1):
+        """Write the free count of count bitmap blocks in their summary block (in the cache)"""
+        if self.number_of_summary_blocks == 0:
+            return
+        position = (bitmap_block_number-1)*2
+        summary_block_number = self.offset_summary+position//self.block_size
+        summary_block = self.mutable_sector(summary_block_number)
+        counts = self.free_counts[bitmap_block_number-1:bitmap_block_number-1+count]
+        summary_block[position%self.block_size:position%self.block_size+2*len(counts)] = (counts+1).astype("<u2").tobytes()
+        self.cache.mark_dirty(summary_block_number)
+
+    def bitmap_bits(self, bitmap_block_number:int)->int:
+        """Number of data blocks tracked by a bitmap block (the last one can be partial)"""
+        first = (bitmap_block_number-1)*self.bits_per_bitmap_block
+        return max(0, min(self.bits_per_bitmap_block, self.number_of_blocks-self.offset_data-first))
+
+    def load_bitmap(self,block_number:int)->bytearray:
+        """Bitmap block (cached bytearray, modified in place), its free bits are counted if unknown"""
+        bitmap_block = self.mutable_sector(block_number)
+        if self.free_counts[block_number-1] < 0:
+            bits = self.bitmap_bits(block_number)
+            used = np.unpackbits(np.frombuffer(bitmap_block, dtype=np.uint8, count=-(-bits//8)), bitorder="little")[:bits]
+            self.free_counts[block_number-1] = bits-int(used.sum())
+            self.save_summary(block_number)
+        return bitmap_block
+
+    def bitmap_position(self, block_pos:int):
+        """(bitmap block number, bit number) of a data block"""
+        block_pos -= self.offset_data
+        return block_pos//self.bits_per_bitmap_block+1, block_pos%self.bits_per_bitmap_block#skip superblock
+
+    def is_used(self, block_pos:int)->bool:
+        bitmap_block_number, bit = self.bitmap_position(block_pos)
+        return bool(self.load_bitmap(bitmap_block_number)[bit>>3] & (1<<(bit&7)))
+
+    def set_bitmap(self, block_pos:int, used:bool):
+        """Mark block_pos as used/free (bit flipped in place in the cached bitmap block)"""
+        bitmap_block_number, bit = self.bitmap_position(block_pos)
+        bitmap_block = self.load_bitmap(bitmap_block_number)
+        if bool(bitmap_block[bit>>3] & (1<<(bit&7))) == used:
+            return
+        bitmap_block[bit>>3] ^= 1<<(bit&7)
+        self.cache.mark_dirty(bitmap_block_number)
+        self.free_counts[bitmap_block_number-1] += -1 if used else 1
+        self.save_summary(bitmap_block_number)
+        self.free_extents.pop(bitmap_block_number, None)
+        if DEBUG:print(f"[*] {block_pos} {bitmap_block_number} {bit>>3} {bit&7}")
+
     def xor_bitmap(self, block_pos:int):
-        """Add/Remove block_pos from bitmap:
-        - Read bitmap block
-        - invert bit at block_pos position
+        """Add/Remove block_pos from bitmap"""
+        self.set_bitmap(block_pos, not self.is_used(block_pos))
+
+    def set_range(self, start:int, count:int, used:bool):
+        """Mark count blocks from start as used/free (one operation per bitmap block)"""
+        while count > 0:
+            bitmap_block_number, bit = self.bitmap_position(start)
+            length = min(count, self.bits_per_bitmap_block-bit)
+            bitmap_block = self.load_bitmap(bitmap_block_number)
+            bits = np.unpackbits(np.frombuffer(bitmap_block, dtype=np.uint8), bitorder="little")
+            changed = length-int(np.count_nonzero(bits[bit:bit+length] == used))
+            bits[bit:bit+length] = used
+            bitmap_block[:] = np.packbits(bits, bitorder="little").tobytes()
+            self.cache.mark_dirty(bitmap_block_number)
+            self.free_counts[bitmap_block_number-1] += -changed if used else changed
+            self.save_summary(bitmap_block_number)
+            self.free_extents.pop(bitmap_block_number, None)
+            start += length
+            count -= length
+
+    def free_blocks(self, blocks:list):
+        """Free blocks, contiguous runs are freed at once"""
+        if blocks:
+            self.blocks_freed = True
+        for start, count in coalesce(sorted(set(blocks))):
+            self.set_range(start, count, False)
+
+    def free_runs(self, bitmap_block_number:int):
+        """(starts, lengths) of the free runs of a bitmap block, kept until the bitmap block changes"""
+        runs = self.free_extents.get(bitmap_block_number)
+        if runs is None:
+            bits = self.bitmap_bits(bitmap_block_number)
+            used = np.unpackbits(np.frombuffer(self.load_bitmap(bitmap_block_number), dtype=np.uint8, count=-(-bits//8)), bitorder="little")[:bits]
+            edges = np.diff(np.concatenate(([1], used, [1])).astype(np.int8))
+            starts = np.flatnonzero(edges == -1)
+            runs = (starts, np.flatnonzero(edges == 1)-starts)
+            self.free_extents[bitmap_block_number] = runs
+        return runs
+
+    def find_extent(self, count:int):
+        """Free (start, length) extent for count blocks:
+        - big files: a row of completely free bitmap blocks
+        - else the first free run >= count, from the bitmap block of the last allocation
+        - else the longest free run of the first bitmap block with free space (length < count)
         """
-        block_pos -= self.offset_data
-        bitmap_block_number = block_pos//self.block_size+1#skip superblock
-        if bitmap_block_number not in self.hot_bitmap_blocks:
-            self.load_bitmap(bitmap_block_number)
-        bitmap_block = self.hot_bitmap_blocks[bitmap_block_number]
-        byte_number = (block_pos%self.block_size)//8
-        bit_number = (block_pos%self.block_size)%8
-        bitmap_block = bitmap_block[:byte_number] + bytes([bitmap_block[byte_number]^(1<<bit_number)]) + bitmap_block[byte_number+1:]
-        self.hot_bitmap_blocks[bitmap_block_number] = bitmap_block
-        # self.write_sector(bitmap_block_number, bitmap_block)
-        if DEBUG:print(f"[*] {block_pos} {bitmap_block_number} {byte_number} {bit_number}")
+        if count > self.bits_per_bitmap_block:
+            edges = np.diff(np.concatenate(([0], (self.free_counts == self.bitmap_capacity).astype(np.int8), [0])))
+            starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+            if len(starts):
+                sizes = np.array([self.bitmap_capacity[first:last].sum() for first, last in zip(starts, ends)])
+                fit = np.flatnonzero(sizes >= count)
+                i = int(fit[0]) if len(fit) else int(np.argmax(sizes))
+                return self.offset_data+int(starts[i])*self.bits_per_bitmap_block, int(min(count, sizes[i]))
+        order = np.roll(np.arange(1, self.number_of_bitmap_blocks+1), 1-self.next_bitmap_block)
+        counts = self.free_counts[order-1]
+        if count <= self.bits_per_bitmap_block:
+            for bitmap_block_number in order[(counts >= count) | (counts < 0)]:
+                starts, lengths = self.free_runs(int(bitmap_block_number))
+                fit = np.flatnonzero(lengths >= count)
+                if len(fit):
+                    return self.offset_data+(int(bitmap_block_number)-1)*self.bits_per_bitmap_block+int(starts[fit[0]]), count
+        for bitmap_block_number in order[counts != 0]:
+            starts, lengths = self.free_runs(int(bitmap_block_number))
+            if len(lengths):
+                i = int(np.argmax(lengths))
+                return self.offset_data+(int(bitmap_block_number)-1)*self.bits_per_bitmap_block+int(starts[i]), int(min(count, lengths[i]))
+        return None
+
+    def allocate_extents(self, count:int)->list:
+        """Reserve count blocks in as few contiguous (start, length) extents as possible, None if there is not enough space"""
+        extents = []
+        while count > 0:
+            extent = self.find_extent(count)
+            if extent is None:
+                for start, length in extents:
+                    self.set_range(start, length, False)
+                return None
+            self.set_range(*extent, True)
+            extents.append(extent)
+            count -= extent[1]
+        if extents:#next allocations go on after this one
+            self.next_bitmap_block, self.next_free_bit = self.bitmap_position(extents[-1][0]+extents[-1][1]-1)
+        return extents
+
+    @staticmethod
+    def pointer_blocks(data_blocks:int)->int:
+        """Number of pointer blocks (indirect, double indirect) of a file of data_blocks blocks"""
+        if data_blocks <= 4:
+            return 0
+        if data_blocks <= 4+1024:
+            return 1
+        return 2+(data_blocks-4-1024+1023)//1024
+
+    @staticmethod
+    def find_free_bit(bitmap_block:bytearray, bits:int, start:int=0)->int:
+        """First 0 bit (< bits) of a bitmap block from start (then from 0), 64 bits at a time"""
+        words = np.frombuffer(bitmap_block, dtype="<u8", count=-(-bits//64))
+        start_word = min(start//64, len(words))
+        for first, last in ((start_word, len(words)), (0, start_word)):
+            free_words = np.flatnonzero(words[first:last] != FULL_WORD)
+            if len(free_words) == 0:
+                continue
+            word_number = first+int(free_words[0])
+            word = int(words[word_number])
+            bit = word_number*64+(~word & (word+1)).bit_length()-1#lowest 0 bit
+            if bit < bits:
+                return bit
+        return None
 
     def save_bitmap(self):
-        """Save bitmap to disk"""
-        for block_pos in self.hot_bitmap_blocks:
-            self.write_sector(block_pos, self.hot_bitmap_blocks[block_pos])
-            # print(f"[*] Saving bitmap block", end="\r")
-        self.hot_bitmap_blocks = {}#clear hot blocks
+        """Save bitmap to disk (commit point at the end of an operation: every dirty block of the cache is written)
+        - journal: group_commit operations are committed together, an operation that freed blocks is committed at once
+          (a freed block can be reused by the next data writes)
+        """
+        self.pending_operations += 1
+        if self.journal_ready and self.pending_operations < self.group_commit and not self.blocks_freed:
+            return
+        self.flush()
         return
 
     def read_inodes(self):
-        """Read all inodes:
+        """Read all inodes (one pass):
         - Read all inode blocks
+        - build the inode table: self.inode_used (1 octet per slot) and the first free slot
         - Return list of valid inodes
         """
         print("[*] Loading inodes...")
         directory = {}
-        for block_position in range(self.number_of_bitmap_blocks+1, self.offset_data+1):
-            inode_block = self.read_sector(block_position)
-            offset_position = block_position-(self.number_of_bitmap_blocks+1)
-            max_inode_in_block = self.block_size//64
-            for j in range(0, self.block_size, 64):#inode size 64
-                try:
-                    #j//max_inode_in_block => position in inode block
-                    #offset_position*self.block_size => offset in inode blocks (in wich block we are)
-                    inode = Inode(inode_block[j:j+64], j//max_inode_in_block+(offset_position*self.block_size)//max_inode_in_block)
-                except Exception as e:
-                    if DEBUG:print(f"[-] Error reading inode: {e}")
-                    continue
-                # if j == 0 and block_position == self.number_of_bitmap_blocks+1:print(inode_block[j:j+64])
-                if inode.valid:directory[inode.name] = inode
-            # percentage = block_position-(self.number_of_bitmap_blocks+1)
-            # print(f"[*] {percentage}/{self.offset_data-self.number_of_bitmap_blocks+1} ({round(percentage/(self.offset_data-self.number_of_bitmap_blocks+1)*100)}%)", end="\r")
+        max_inode_in_block = self.block_size//64
+        self.inode_used = np.zeros(self.number_of_inode_blocks*max_inode_in_block, dtype=bool)
+        self.next_free_inode = 0
+        #blocks after inode_blocks_used were never written, the others are read by batches (decrypted on a thread / by the workers)
+        inode_blocks = self.inode_blocks_used if self.inode_blocks_used >= 0 else self.number_of_inode_blocks
+        self.inode_blocks_used = 0
+        tails = {}#tail block: used units
+        blocks = ReadAhead(range(self.offset_inodes, self.offset_inodes+inode_blocks), self.read_sectors, self.batch_size)
+        for offset_position, inode_block in enumerate(blocks):
+            if not inode_block:#never written: only free slots
+                continue
+            self.inode_blocks_used = offset_position+1
+            #offset_position*max_inode_in_block => first slot of this inode block
+            for inode in Inode.from_block(inode_block, offset_position*max_inode_in_block):
+                self.inode_used[inode.position] = True
+                if not inode.flags & INODE_NESTED:#the others are found through their directory
+                    directory[inode.name] = inode
+                if inode.flags & INODE_TAIL:
+                    tails[inode.direct[0]] = tails.get(inode.direct[0], 0)+(-(-inode.size//TAIL_UNIT))
+            # percentage = block_position-self.offset_inodes
+            # print(f"[*] {percentage}/{self.offset_data-self.offset_inodes} ({round(percentage/(self.offset_data-self.offset_inodes)*100)}%)", end="\r")
+        self.tail_blocks = OrderedDict((block, free) for block, free in
+                                       ((block, self.block_size//TAIL_UNIT-1-used) for block, used in sorted(tails.items())) if free > 0)
         return directory
     
     def add_inode(self, inode:Inode):
-        """Update needed inode blocks:
-        - for all inode blocks, if block is full skip, else write inodes
-        """
-        for block_position in range(self.number_of_bitmap_blocks+1, self.offset_data+1):
-            inode_block = self.read_sector(block_position)
-            offset_position = block_position-(self.number_of_bitmap_blocks+1)
-            max_inode_in_block = self.block_size//64
-            for j in range(0, self.block_size, 64):
-                test_inode = Inode(inode_block[j:j+64], j//max_inode_in_block+(offset_position*self.block_size)//max_inode_in_block)
-                if not test_inode.valid:
-                    inode_block = inode_block[:j] + inode.to_bytes() + inode_block[j+64:]
-                    self.write_sector(block_position, inode_block)
-                    return
-        raise Exception("Maximum number of inodes reached")
+        """Write a new inode in its slot (from find_free_inode), one inode block write"""
+        self.update_node(inode)
+        self.inode_used[inode.position] = True
+        self.next_free_inode = inode.position+1
+        self.inode_blocks_used = max(self.inode_blocks_used, inode.position//(self.block_size//64)+1)
+
+    def read_index(self)->dict:
+        """Directory from the directory index (one read of contiguous blocks), None if there is no valid index"""
+        if not self.directory_index or self.index_start == 0:
+            return None
+        print("[*] Loading directory index...")
+        index = b"".join(bytes(block).ljust(self.block_size, b"\x00") for block in self.read_sectors(list(range(self.index_start, self.index_start+self.index_blocks))))
+        count = int.from_bytes(index[4:8], byteorder="big")
+        if index[:4] != self.index_magic_number or count != int.from_bytes(self.read_sector(0)[12:16], byteorder="big"):
+            if DEBUG:print("[-] Invalid directory index")
+            return None
+        directory = {}
+        slots = self.number_of_inode_blocks*(self.block_size//64)
+        record = struct.Struct(">I"+Inode.layout.format[1:])#slot number + inode
+        used = index[8+count*record.size:8+count*record.size+(slots+7)//8].ljust((slots+7)//8, b"\x00")
+        self.inode_used = np.unpackbits(np.frombuffer(used, dtype=np.uint8))[:slots].astype(bool)
+        tails = index[8+count*record.size+(slots+7)//8:]#tail blocks with free units (0 in indexes written before)
+        tail_count = int.from_bytes(tails[:4].ljust(4, b"\x00"), byteorder="big")
+        self.tail_blocks = OrderedDict((int.from_bytes(tails[4+5*i:8+5*i], byteorder="big"), tails[8+5*i]) for i in range(tail_count))
+        self.next_free_inode = 0
+        for position, *fields in record.iter_unpack(index[8:8+count*record.size]):
+            inode = Inode.from_fields(fields, position)
+            directory[inode.name] = inode
+            self.inode_used[position] = True
+        return directory
+
+    def write_index(self):
+        """Save every inode in a directory index (contiguous blocks, recorded in the superblock)"""
+        index = self.index_magic_number + len(self.directory).to_bytes(4, byteorder="big")
+        index += b"".join(inode.position.to_bytes(4, byteorder="big") + inode.to_bytes() for inode in self.directory.values())
+        index += np.packbits(self.inode_used).tobytes()
+        index += len(self.tail_blocks).to_bytes(4, byteorder="big")
+        index += b"".join(block.to_bytes(4, byteorder="big") + bytes([free]) for block, free in self.tail_blocks.items())
+        count = -(-len(index)//self.block_size)
+        extents = self.allocate_extents(count)
+        if extents is None:
+            return
+        if len(extents) > 1:#only read in one go
+            self.free_blocks([block for start, length in extents for block in range(start, start+length)])
+            return
+        self.index_start, self.index_blocks = extents[0]
+        self.write_sectors([(self.index_start+i, index[i*self.block_size:(i+1)*self.block_size]) for i in range(count)])
+        self.update_superblock()
+
+    def drop_index(self):
+        """The inodes changed: the directory index is not valid anymore"""
+        if self.index_start == 0:
+            return
+        self.set_range(self.index_start, self.index_blocks, False)
+        self.index_start, self.index_blocks = 0, 0
+        self.update_superblock()
+
+    def remove_inode(self, inode:Inode):
+        """Write the (invalid) inode and give its slot back"""
+        self.update_node(inode)
+        self.inode_used[inode.position] = False
+        self.next_free_inode = min(self.next_free_inode, inode.position)
+        self.pointer_cache.pop(inode.position, None)
 
     def update_node(self, inode:Inode):
         """Update inode:
-        - Write inode to inode block
-        position: position in inode block (0-n) (64 octets per inode and we have block_size/64 inodes per block)
+        - Write inode to inode block (in place in the cached block)
+        position: slot number (64 octets per inode and we have block_size/64 inodes per block)
         """
-        offset = self.number_of_bitmap_blocks+1
+        self.drop_index()
         max_inode_in_block = self.block_size//64
-        inode_block = self.read_sector(offset+(inode.position//max_inode_in_block))
-        inode_block = inode_block[:64*(inode.position%max_inode_in_block)] + inode.to_bytes() + inode_block[64*(inode.position%max_inode_in_block)+64:]
-        self.write_sector(offset+(inode.position//max_inode_in_block), inode_block)
+        block_position = self.offset_inodes+inode.position//max_inode_in_block
+        inode_block = self.mutable_sector(block_position)
+        j = 64*(inode.position%max_inode_in_block)
+        inode_block[j:j+64] = inode.to_bytes()
+        self.cache.mark_dirty(block_position)
         return True
 
     def find_file(self, filename:str)->Inode:
         """Find file in directory:
-        - Search for file in self.directory
-        - Read inode
+        - root entries: search for file in self.directory
+        - paths ("dir/sub/file"): one bucket block per directory on the way (resolve)
         """
         if filename in self.directory:
             return self.directory[filename]
+        return self.resolve(filename)
+
+    @staticmethod
+    def split_path(path:str)->list:
+        """Names of a path ("/a//b/" -> ["a", "b"]), [] for the root directory"""
+        return [part for part in path.replace("\\", "/").split("/") if part]
+
+    def resolve(self, path:str)->Inode:
+        """Inode of a path, None if it does not exist"""
+        located = self.locate(path)
+        return located[2] if located is not None else None
+
+    def locate(self, path:str):
+        """(parent directory inode (None: root), name, inode or None) of a path, None if its parent directory does not exist"""
+        parts = self.split_path(path)
+        if not parts:
+            return None
+        parent = None
+        for part in parts[:-1]:
+            parent = self.lookup(parent, part)
+            if parent is None or not parent.is_directory():
+                return None
+        return parent, parts[-1], self.lookup(parent, parts[-1])
+
+    def lookup(self, parent:Inode, name:str)->Inode:
+        """Entry of a directory (None: root directory), None if not found"""
+        if parent is None:
+            return self.directory.get(name)
+        bucket = self.read_bucket(parent, self.bucket_of(parent, name))
+        for entry_name, slot, _, _ in self.bucket_entries(bucket):
+            if entry_name == name:
+                return self.read_inode(slot, name)
         return None
 
+    def valid_name(self, parent:Inode, name:str)->bool:
+        """Root names fit in the inode (32 octets), the others in a bucket entry (255 octets)"""
+        size = len(name.encode('utf-8'))
+        if name in (".", "..") or "/" in name or "\\" in name or size == 0:
+            print(f"[-] Invalid name: {name}")
+            return False
+        if size > (32 if parent is None else 255):
+            print(f"[-] Name too long: {name}")
+            return False
+        return True
+
+    def read_inode(self, slot:int, name:str=None)->Inode:
+        """Inode of a slot (one inode block read, usually cached), name: full name from the directory entry"""
+        max_inode_in_block = self.block_size//64
+        inode_block = bytes(self.read_sector(self.offset_inodes+slot//max_inode_in_block)).ljust(self.block_size, b"\x00")
+        j = 64*(slot%max_inode_in_block)
+        inode = Inode(inode_block[j:j+64], slot)
+        if not inode.valid:
+            return None
+        if name is not None:
+            inode.name = name
+        return inode
+
+    def pointer_at(self, inode:Inode, index:int, pointers:dict=None)->int:
+        """Block number of the index-th data block of a file (at most 2 pointer blocks read), 0 if there is none
+        - pointers: decoded pointer blocks of this file (see file_pointers), filled on the way
+        """
+        if inode.is_small():
+            return 0
+        if index < 4:
+            return inode.direct[index]
+        index -= 4
+        per_block = self.block_size//4
+        block = inode.indirect
+        if index >= per_block:
+            index -= per_block
+            if inode.double_indirect == 0:
+                return 0
+            block = self.read_pointer(inode.double_indirect, index//per_block, pointers)
+            index %= per_block
+        if block == 0:
+            return 0
+        return self.read_pointer(block, index, pointers)
+
+    def read_pointer(self, block:int, index:int, pointers:dict=None)->int:
+        """index-th pointer of a pointer block"""
+        if pointers is None:
+            return int.from_bytes(self.read_sector(block)[4*index:4*index+4], byteorder="big")
+        decoded = pointers.get(block)
+        if decoded is None:
+            decoded = np.frombuffer(bytes(self.read_sector(block)).ljust(self.block_size, b"\x00"), dtype=">u4")
+            pointers[block] = decoded
+        return int(decoded[index])
+
+    def file_pointers(self, inode:Inode)->dict:
+        """Decoded pointer blocks of a file (block: pointers), kept for the last files read
+        until the file changes (write_data, remove_inode), compressed files: "frames" table and last "frame" too"""
+        pointers = self.pointer_cache.pop(inode.position, None)
+        if pointers is None:
+            pointers = {}
+        self.pointer_cache[inode.position] = pointers#most recent last
+        while len(self.pointer_cache) > self.pointer_cache_files:
+            self.pointer_cache.popitem(last=False)
+        return pointers
+
+    def read_range(self, filename:str, offset:int, length:int)->bytes:
+        """Read length octets of a file from offset (random access):
+        - each block of the range is mapped with pointer_at (O(1) pointer blocks, decoded once per file)
+        - only the blocks covering the range are read (contiguous runs decrypted in one call)
+        - returns exactly length octets, less at the end of the file (b"" after it), None if the file does not exist
+        """
+        if offset < 0 or length < 0:
+            raise ValueError(f"Invalid range: offset {offset}, length {length}")
+        inode = self.find_file(filename)
+        if inode is None:
+            return None
+        return self.read_at(inode, offset, length)
+
+    def read_at(self, inode:Inode, offset:int, length:int)->bytes:
+        """read_range of an inode"""
+        end = min(offset+length, inode.size)
+        if offset >= end:
+            return b""
+        if inode.is_small():
+            return self.read_small(inode)[offset:end]
+        if inode.flags & INODE_COMPRESSED:
+            pointers = self.file_pointers(inode)
+            frame_size = self.frame_table(inode, pointers)[1]
+            first = offset//frame_size
+            data = b"".join(self.read_frame(inode, index, pointers) for index in range(first, (end-1)//frame_size+1))
+            return data[offset-first*frame_size:end-first*frame_size]
+        first, last = offset//self.block_size, (end-1)//self.block_size
+        pointers = self.file_pointers(inode)
+        blocks = [self.pointer_at(inode, index, pointers) for index in range(first, last+1)]
+        if 0 in blocks:
+            raise Exception(f"Corrupted file: {inode.name} (block {first+blocks.index(0)} has no pointer)")
+        data = b"".join(bytes(block).ljust(self.block_size, b"\x00") for block in self.read_sectors(blocks))
+        return data[offset-first*self.block_size:end-first*self.block_size]
+
+    def codec(self, name:str):
+        """Codec instance of a compression name (None or "none": no compression)"""
+        if name is None or name == "none":
+            return None
+        if name not in CODECS:
+            raise ValueError(f"Unknown compression: {name}")
+        return CODECS[name]()
+
+    def frame_table(self, inode:Inode, pointers:dict)->tuple:
+        """(codec, frame size, table blocks, frames (first block, compressed length)) of a compressed file, kept with its pointers"""
+        table = pointers.get("frames")
+        if table is None:
+            bs = self.block_size
+            header = bytes(self.read_sector(self.pointer_at(inode, 0, pointers)))[:8]
+            if header[:4] != FRAME_MAGIC or header[4] not in CODEC_IDS or header[5] == 0:
+                raise Exception(f"Corrupted file: {inode.name} (invalid frame table)")
+            frame_size = header[5]*bs
+            frames = -(-inode.size//frame_size)
+            table_blocks = -(-(8+8*frames)//bs)
+            blocks = [self.pointer_at(inode, index, pointers) for index in range(table_blocks)]
+            data = b"".join(bytes(block).ljust(bs, b"\x00") for block in self.read_sectors(blocks))
+            entries = np.frombuffer(data, dtype=">u4", count=2*frames, offset=8).reshape(frames, 2)
+            table = (CODEC_IDS[header[4]](), frame_size, table_blocks, entries)
+            pointers["frames"] = table
+        return table
+
+    def read_frame(self, inode:Inode, index:int, pointers:dict)->bytes:
+        """index-th frame of a compressed file, decompressed (the last one read is kept with the pointers)"""
+        cached = pointers.get("frame")
+        if cached is not None and cached[0] == index:
+            return cached[1]
+        codec, frame_size, _, entries = self.frame_table(inode, pointers)
+        start, length = int(entries[index][0]), int(entries[index][1])
+        stored = length or min(frame_size, inode.size-index*frame_size)
+        blocks = [self.pointer_at(inode, start+i, pointers) for i in range(-(-stored//self.block_size))]
+        if 0 in blocks:
+            raise Exception(f"Corrupted file: {inode.name} (frame {index} has no pointer)")
+        data = b"".join(bytes(block).ljust(self.block_size, b"\x00") for block in self.read_sectors(blocks))[:stored]
+        if length:
+            data = codec.decompress(data)
+        pointers["frame"] = (index, data)
+        return data
+
+    def read_small(self, inode:Inode)->bytes:
+        """Data of an inline file (no block read) or of a tail packed file (its tail block)"""
+        if inode.flags & INODE_INLINE:
+            return inode.inline_data()
+        start = inode.direct[1]*TAIL_UNIT
+        return bytes(self.read_sector(inode.direct[0]))[start:start+inode.size].ljust(inode.size, b"\x00")
+
+    def store_small(self, inode:Inode, data:bytes)->bool:
+        """Store the data of a file without data block of its own (inline or in a tail block),
+        the old small data of the inode is freed (regular blocks are not: new inodes or freed by the caller)
+        - False if it is too big (or empty), small_files is off or no tail block is free, the inode is not changed then
+        """
+        if not self.small_files or not 0 < len(data) <= self.block_size//2:
+            return False
+        if len(data) <= INLINE_SIZE:
+            self.free_small(inode)
+            inode.flags |= INODE_INLINE
+            inode.set_inline_data(data)
+        else:
+            units = -(-len(data)//TAIL_UNIT)
+            tail = self.allocate_tail(units)
+            if tail is None:
+                return False
+            block, unit = tail
+            self.mutable_sector(block)[unit*TAIL_UNIT:unit*TAIL_UNIT+len(data)] = data
+            self.cache.mark_dirty(block)
+            self.free_small(inode)#after the allocation: the new data may share the tail block of the old one
+            inode.flags |= INODE_TAIL
+            inode.direct, inode.indirect, inode.double_indirect = [block, unit, 0, 0], 0, 0
+        inode.size = len(data)
+        self.pointer_cache.pop(inode.position, None)
+        return True
+
+    def free_small(self, inode:Inode):
+        """Free the units of a tail packed file (the tail block when it is empty), the inode has no data after"""
+        if inode.flags & INODE_TAIL:
+            block, unit = inode.direct[0], inode.direct[1]
+            units = -(-inode.size//TAIL_UNIT)
+            used = int.from_bytes(self.read_sector(block)[:8], byteorder="little") & ~(((1 << units)-1) << unit)
+            if used == 1:#only the occupancy bits left
+                self.tail_blocks.pop(block, None)
+                self.cache.discard([block])
+                self.free_blocks([block])
+            else:
+                self.mark_tail(block, used)
+        inode.flags &= ~(INODE_INLINE | INODE_TAIL)
+        inode.direct, inode.indirect, inode.double_indirect = [0]*4, 0, 0
+
+    def unpack_small(self, inode:Inode)->bool:
+        """Move the data of a small file to a data block of its own (it grows past block_size/2), False if the disk is full"""
+        block = self.find_free_data_block()
+        if block is None:
+            print("[-] Not enough space")
+            return False
+        self.write_sectors([(block, self.read_small(inode))])
+        self.free_small(inode)
+        inode.direct[0] = block
+        self.pointer_cache.pop(inode.position, None)
+        self.update_node(inode)
+        return True
+
+    def free_data(self, inode:Inode):
+        """Free the blocks of a file (small files: their tail units)"""
+        self.free_blocks(self.file_blocks(inode))
+        self.free_small(inode)
+
+    def allocate_tail(self, units:int)->tuple:
+        """(tail block, first unit) of units free units: known tail blocks first (the 64 most recent with enough free units), else a new tail block"""
+        mask = (1 << units)-1
+        for block in reversed([block for block, free in self.tail_blocks.items() if free >= units][-64:]):
+            used = int.from_bytes(self.read_sector(block)[:8], byteorder="little")
+            for unit in range(1, self.block_size//TAIL_UNIT-units+1):
+                if not used & (mask << unit):
+                    self.mark_tail(block, used | (mask << unit))
+                    return block, unit
+        block = self.find_free_data_block()
+        if block is None:
+            return None
+        self.write_sector(block, b"")
+        self.mark_tail(block, 1 | (mask << 1))
+        return block, 1
+
+    def mark_tail(self, block:int, used:int):
+        """Write the occupancy bits of a tail block and remember its free units"""
+        self.mutable_sector(block)[:8] = used.to_bytes(8, byteorder="little")
+        self.cache.mark_dirty(block)
+        self.tail_blocks.pop(block, None)
+        free = self.block_size//TAIL_UNIT-bin(used).count("1")
+        if free:
+            self.tail_blocks[block] = free
+
+    def buckets(self, directory:Inode)->int:
+        return directory.size//self.block_size
+
+    def bucket_of(self, directory:Inode, name:str)->int:
+        return zlib.crc32(name.encode('utf-8')) & (self.buckets(directory)-1)
+
+    def read_bucket(self, directory:Inode, bucket:int)->bytes:
+        pointer = self.pointer_at(directory, bucket)
+        if pointer == 0:
+            raise Exception(f"Corrupted directory: {directory.name}")
+        return self.read_sector(pointer)
+
+    @staticmethod
+    def bucket_entries(bucket:bytes)->Generator[tuple, None, None]:
+        """(name, slot, start, end) of the entries of a bucket block"""
+        position = 0
+        while position+5 <= len(bucket):
+            slot = int.from_bytes(bucket[position:position+4], byteorder="big")
+            if slot == 0:
+                return
+            end = position+5+bucket[position+4]
+            yield bytes(bucket[position+5:end]).decode('utf-8'), slot-1, position, end
+            position = end
+
+    @staticmethod
+    def entry(name:str, slot:int)->bytes:
+        name = name.encode('utf-8')
+        return (slot+1).to_bytes(4, byteorder="big") + len(name).to_bytes(1, byteorder="big") + name
+
+    def directory_entries(self, directory:Inode)->Generator[tuple, None, None]:
+        """(name, slot) of every entry of a directory, only its own blocks are read"""
+        for bucket in self.read_blocks(directory):
+            for name, slot, _, _ in self.bucket_entries(bucket):
+                yield name, slot
+
+    def list_directory(self, path:str="")->dict:
+        """name: Inode of the entries of a directory ("" or "/": root), None if it is not a directory"""
+        if not self.split_path(path):
+            return dict(self.directory)
+        directory = self.resolve(path)
+        if directory is None or not directory.is_directory():
+            return None
+        entries = {}
+        for name, slot in self.directory_entries(directory):
+            inode = self.read_inode(slot, name)
+            if inode is not None:
+                entries[name] = inode
+        return entries
+
+    def link(self, parent:Inode, name:str, inode:Inode)->bool:
+        """Add an entry for inode in a directory (None: root directory), the inode flags follow its parent"""
+        inode.name = name
+        if parent is None:
+            inode.flags &= ~INODE_NESTED
+            self.directory[name] = inode
+            return True
+        inode.flags |= INODE_NESTED
+        bucket_number = self.bucket_of(parent, name)
+        pointer = self.pointer_at(parent, bucket_number)
+        bucket = self.read_sector(pointer)
+        used = max([end for _, _, _, end in self.bucket_entries(bucket)], default=0)
+        entry = self.entry(name, inode.position)
+        if used+len(entry) <= self.block_size:
+            self.write_sector(pointer, bytes(bucket[:used])+entry)
+            return True
+        return self.grow_directory(parent, [(name, inode.position)])
+
+    def unlink(self, parent:Inode, name:str):
+        """Remove an entry from a directory (None: root directory)"""
+        if parent is None:
+            del self.directory[name]
+            return
+        pointer = self.pointer_at(parent, self.bucket_of(parent, name))
+        bucket = self.read_sector(pointer)
+        for entry_name, _, start, end in self.bucket_entries(bucket):
+            if entry_name == name:
+                self.write_sector(pointer, bytes(bucket[:start])+bytes(bucket[end:]))
+                return
+
+    def grow_directory(self, directory:Inode, added:list)->bool:
+        """Double the buckets of a directory until every entry fits, the directory blocks are written again"""
+        entries = list(self.directory_entries(directory))+added
+        count = self.buckets(directory)
+        while True:
+            count *= 2
+            if count > 4+1024+1024*1024:
+                print("[-] Directory too big")
+                return False
+            buckets = [b""]*count
+            for name, slot in entries:
+                buckets[zlib.crc32(name.encode('utf-8')) & (count-1)] += self.entry(name, slot)
+            if max(len(bucket) for bucket in buckets) <= self.block_size:
+                break
+        old_blocks = self.file_blocks(directory)
+        old_pointers = (directory.size, list(directory.direct), directory.indirect, directory.double_indirect)
+        self.flush()#the buckets are written by write_data, the cached ones go first
+        directory.size = count*self.block_size
+        directory.direct, directory.indirect, directory.double_indirect = [0]*4, 0, 0
+        if self.write_data(directory, io.BytesIO(b"".join(bucket.ljust(self.block_size, b"\x00") for bucket in buckets))) == -1:
+            directory.size, directory.direct, directory.indirect, directory.double_indirect = old_pointers
+            return False
+        self.free_blocks(old_blocks)
+        self.cache.discard(old_blocks)
+        self.update_node(directory)
+        return True
+
+    def mkdir(self, path:str)->bool:
+        """Create an empty directory (1 bucket)"""
+        located = self.locate(path)
+        if located is None or located[2] is not None:
+            return False
+        parent, name, _ = located
+        if not self.valid_name(parent, name):
+            return False
+        inode = self.find_free_inode()
+        if inode is None:
+            return False
+        block = self.find_free_data_block()
+        if block is None:
+            return False
+        self.write_sector(block, b"")
+        inode.valid, inode.flags, inode.size = True, INODE_DIRECTORY, self.block_size
+        inode.direct, inode.indirect, inode.double_indirect = [block, 0, 0, 0], 0, 0
+        if not self.link(parent, name, inode):
+            self.free_blocks([block])
+            return False
+        self.add_inode(inode)
+        self.update_superblock()
+        self.save_bitmap()
+        return True
+
+    def read_pointer_block(self, block:int)->list:
+        """Read a pointer block and return the pointers until the first 0"""
+        pointer_block = self.read_sector(block)
+        pointers = []
+        for i in range(0, len(pointer_block), 4):
+            pointer = int.from_bytes(pointer_block[i:i+4], byteorder="big")
+            if pointer == 0:
+                break
+            pointers.append(pointer)
+        return pointers
+
+    def data_pointers(self, inode:Inode)->Generator[int, None, None]:
+        """Yield the data block numbers of a file in order (direct, indirect, double indirect), none for small files"""
+        if inode.is_small():
+            return
+        for i in range(4):
+            if inode.direct[i] == 0:
+                return
+            yield inode.direct[i]
+        if inode.indirect == 0:
+            return
+        if DEBUG:print(f"[*] Reading indirect block {inode.indirect}")
+        yield from self.read_pointer_block(inode.indirect)
+        if inode.double_indirect == 0:
+            return
+        for indirect_pointer in self.read_pointer_block(inode.double_indirect):
+            if DEBUG:print(f"[*] Reading double indirect block {indirect_pointer}")
+            yield from self.read_pointer_block(indirect_pointer)
+
+    def file_blocks(self, inode:Inode)->list:
+        """Every block of a file: data blocks and pointer blocks (none for small files, see free_small)"""
+        if inode.is_small():
+            return []
+        blocks = list(self.data_pointers(inode))
+        if inode.indirect != 0:
+            blocks.append(inode.indirect)
+        if inode.double_indirect != 0:
+            blocks.append(inode.double_indirect)
+            blocks += self.read_pointer_block(inode.double_indirect)
+        return blocks
+
     def read_file(self, filename:str)->Generator[bytes, None, None]:
         """Read file from disk:
         - Search for file in directory (in memory)
         - Read inode
-        - Read data blocks
+        - Read data blocks (batch_size blocks per call, or prefetched by a ReadAhead thread)
+        - the last block is cut to the file size (exactly inode.size octets in total)
         """
         inode = self.find_file(filename)
         try:
             if inode is None:
                 return None
-            for i in range(4):
-                if inode.direct[i] == 0:
+            remaining = inode.size
+            for block in self.read_blocks(inode):
+                if remaining <= 0:
                     break
-                yield self.read_sector(inode.direct[i])
-            if inode.indirect != 0:
-                indirect_block = self.read_sector(inode.indirect)
-                for i in range(0, self.block_size, 4):
-                    pointer = int.from_bytes(indirect_block[i:i+4], byteorder="big")
-                    if pointer == 0:
-                        break
-                    if DEBUG:print(f"[*] Reading indirect block {pointer}")
-                    yield self.read_sector(pointer)
-            if inode.double_indirect != 0:
-                double_indirect_block = self.read_sector(inode.double_indirect)
-                for i in range(0, self.block_size, 4):
-                    indirect_pointer = int.from_bytes(double_indirect_block[i:i+4], byteorder="big")
-                    if pointer == 0:
-                        break
-                    if DEBUG:print(f"[*] Reading double indirect block {indirect_pointer}")
-                    indirect_block = self.read_sector(indirect_pointer)
-                    for j in range(0, self.block_size, 4):
-                        pointer = int.from_bytes(indirect_block[j:j+4], byteorder="big")
-                        if pointer == 0:
-                            break
-                        if DEBUG:print(f"[*] Reading indirect block {pointer}")
-                        yield self.read_sector(pointer)
+                if len(block) > remaining:
+                    block = block[:remaining]
+                elif len(block) < min(self.block_size, remaining):#never written block (decrypted as b"")
+                    block = bytes(block).ljust(min(self.block_size, remaining), b"\x00")
+                yield block
+                remaining -= len(block)
         except KeyboardInterrupt:
             print("[-] Cancelled reading file")
             return None
         return
 
+    def read_blocks(self, inode:Inode)->Generator[bytes, None, None]:
+        """Data blocks of an inode in order (small files: their data)"""
+        if inode.is_small():
+            yield self.read_small(inode)
+            return
+        if inode.flags & INODE_COMPRESSED:
+            pointers = self.file_pointers(inode)
+            for index in range(len(self.frame_table(inode, pointers)[3])):
+                yield self.read_frame(inode, index, pointers)
+            return
+        if self.readahead > 0:
+            yield from ReadAhead(self.data_pointers(inode), self.read_sectors, self.readahead)
+            return
+        batch = []
+        for pointer in self.data_pointers(inode):
+            batch.append(pointer)
+            if len(batch) >= self.batch_size:
+                yield from self.read_sectors(batch)
+                batch = []
+        if batch:
+            yield from self.read_sectors(batch)
+
     def find_free_inode(self)->Inode:
         """Find free inode:
-        - Read all inodes
-        - Return first free inode
+        - first free slot of the inode table from next_free_inode (no inode block read)
+        - the slot is taken by add_inode
         """
-        for i in range(self.number_of_bitmap_blocks+1, self.offset_data):
-            inode_block = self.read_sector(i)
-            for j in range(0, self.block_size, 64):#inode size 64
-                inode = Inode(inode_block[j:j+64], j)
-                if not inode.valid:
-                    return inode
+        window = self.block_size//64
+        while self.next_free_inode < len(self.inode_used):
+            free = np.flatnonzero(~self.inode_used[self.next_free_inode:self.next_free_inode+window])
+            if len(free):
+                self.next_free_inode += int(free[0])
+                return Inode(b"\x00", self.next_free_inode)
+            self.next_free_inode += window
         return None
 
-    def create_file(self, filename:str,path:str):
+    def open(self, name:str, mode:str="rb", compression:str=None):
+        """File object of a file (name or path), works with shutil.copyfileobj:
+        - "rb": FileReader (readable, seekable)
+        - "wb": FileWriter, creates the file (replaces it if it exists) on close
+        - "ab": FileWriter, appends to the file (created if it does not exist), a file keeps its format
+          (compressed: its codec, uncompressed data blocks: no compression)
+        - compression: codec of the written file ("zlib", "lzma", "none"), None: the one of the volume
+        """
+        if mode not in ("rb", "wb", "ab"):
+            raise ValueError(f"Unsupported mode: {mode}")
+        located = self.locate(name)
+        if located is None:
+            raise FileNotFoundError(f"No such file or directory: {name}")
+        parent, entry, inode = located
+        if inode is not None and inode.is_directory():
+            raise IsADirectoryError(f"Is a directory: {name}")
+        if mode == "rb":
+            if inode is None:
+                raise FileNotFoundError(f"No such file or directory: {name}")
+            return FileReader(self, inode)
+        if inode is None:
+            if not self.valid_name(parent, entry):
+                raise ValueError(f"Invalid name: {name}")
+            inode = self.find_free_inode()
+            if inode is None:
+                raise OSError("No free inode left")
+            inode.name = entry
+        codec = self.compression if compression is None else self.codec(compression)
+        return FileWriter(self, name, inode, append=mode == "ab", codec=codec)
+
+    def create_file(self, filename:str,path:str,compression:str=None):
         """Create file on disk:
-            - Search for file in directory (in memory)
+            - filename: name in the root directory or path ("dir/sub/file", the directories must exist)
+            - path: host file, bytes-like data, or a binary file object / iterable of bytes (streamed with open(filename, "wb"), size not needed)
+            - compression: see open (compressed host files are streamed too)
             - If file exists, return False
             - Find free inode
             - Write data to data blocks
             - Update inode
             - Update directory
         """
-        if filename in self.directory:
+        located = self.locate(filename)
+        if located is None or located[2] is not None:
+            return False
+        parent, name, _ = located
+        if not self.valid_name(parent, name):
             return False
+        codec = self.compression if compression is None else self.codec(compression)
+        if isinstance(path, (bytes, bytearray, memoryview)):#one chunk, not an iterable of ints
+            path = io.BytesIO(path)
+        if isinstance(path, str) and codec is not None and os.path.getsize(path) > self.block_size//2:
+            with open(path, "rb") as source:
+                return self.create_file(filename, source, codec.name)
+        if not isinstance(path, str):
+            try:
+                with self.open(filename, "wb", compression) as file:
+                    if hasattr(path, "read"):
+                        shutil.copyfileobj(path, file, self.batch_size*self.block_size)
+                    else:
+                        for chunk in path:
+                            file.write(chunk)
+            except (KeyboardInterrupt, OSError, ValueError, TypeError) as e:
+                print("[-] Cancelled writing file" if isinstance(e, KeyboardInterrupt) else f"[-] Error writing file: {e}")
+                return False
+            return True
         inode = self.find_free_inode()
         if inode is None:
             return False
         inode.size = os.path.getsize(path)
-        inode.name = filename
+        inode.name = name
         inode.valid = True
+        inode.flags = 0
         inode.direct = [0]*4
         inode.indirect = 0
         inode.double_indirect = 0
-        test = self.write_data(inode, path)
-        if test == -1:
+        stored = False
+        if self.small_files and 0 < inode.size <= self.block_size//2:#no data block: inline or tail packed
+            with open(path, "rb") as file:
+                stored = self.store_small(inode, file.read(inode.size))
+        if not stored and self.write_data(inode, path) == -1:
+            return False
+        if not self.link(parent, name, inode):
+            self.free_data(inode)
             return False
         self.add_inode(inode)
-        self.directory[filename] = inode
         self.update_superblock()
         self.save_bitmap()
         return True
     
+    def create_files(self, source, destination:str="", batch_files:int=1024, progress=None, compression:str=None)->dict:
+        """Import many host files at once:
+        - source: host directory (its tree is copied in destination, sub directories are created) or list of host file paths
+        - destination: directory of the filesystem ("": root), created with its parents if it does not exist
+        - by batches of batch_files files: inode slots and blocks of the whole batch are planned up front (one allocation),
+          the files go through one WritePipeline, then the entries are linked and inode blocks, bitmap blocks
+          and superblock are committed once
+        - progress(files done, files, octets written) is called after each file (default: printed every 100 files with the throughput)
+        - compression: see open, compressed files (bigger than block_size/2) are streamed one by one after the others of their batch
+        - returns {"files", "failed" (paths), "bytes", "seconds", "throughput" (octets/s)}
+        """
+        start = time.perf_counter()
+        stats = {"files": 0, "failed": [], "bytes": 0, "seconds": 0, "throughput": 0}
+        parts = self.split_path(destination)
+        for i in range(len(parts)):#missing destination directories
+            path = "/".join(parts[:i+1])
+            inode = self.resolve(path)
+            if (inode is None and not self.mkdir(path)) or (inode is not None and not inode.is_directory()):
+                print(f"[-] Destination not found: cannot create directory {path}")
+                stats["failed"] = [source] if isinstance(source, str) else list(source)
+                return stats
+        if isinstance(source, str):
+            files = []
+            for root, directories, names in os.walk(source):
+                relative = os.path.relpath(root, source)
+                target = "/".join(self.split_path(destination)+([] if relative == "." else self.split_path(relative)))
+                for directory in sorted(directories):
+                    path = f"{target}/{directory}" if target else directory
+                    if self.resolve(path) is None and not self.mkdir(path):
+                        print(f"[-] Cannot create directory {path}")
+                directories.sort()
+                files += [(os.path.join(root, name), f"{target}/{name}" if target else name) for name in sorted(names)]
+        else:
+            target = "/".join(self.split_path(destination))
+            files = [(path, f"{target}/{os.path.basename(path)}" if target else os.path.basename(path)) for path in source]
+        for first in range(0, len(files), batch_files):
+            if not self.import_batch(files[first:first+batch_files], stats, len(files), start, progress, compression):
+                stats["failed"] += [path for path, _ in files[first+batch_files:]]
+                break
+        stats["seconds"] = time.perf_counter()-start
+        stats["throughput"] = stats["bytes"]/stats["seconds"] if stats["seconds"] else 0
+        print(f"\n[*] {stats['files']} files imported ({self.disk.to_humain_readable(stats['bytes'])}) in {stats['seconds']:.2f}s, "
+              f"{self.disk.to_humain_readable(stats['throughput'])}/s, {len(stats['failed'])} failed")
+        return stats
+
+    def import_batch(self, files:list, stats:dict, total:int, start:float, progress=None, compression:str=None)->bool:
+        """One batch of create_files ((host path, path) pairs), False if it was cancelled"""
+        codec = self.compression if compression is None else self.codec(compression)
+        planned = []#(host path, parent, name, inode)
+        streamed = []#(host path, path) of the compressed files
+        parents = {}#directory path: inode (None: root)
+        names = set()
+        slots = np.flatnonzero(~self.inode_used)
+        for host_path, path in files:
+            located = self.locate(path)
+            size = os.path.getsize(host_path) if os.path.isfile(host_path) else -1
+            if (located is None or located[2] is not None or path in names or not self.valid_name(located[0], located[1])
+                    or not 0 <= size <= self.block_size*(4+1024+1024*1024) or len(planned) >= len(slots)):
+                print(f"[-] Cannot import {host_path} as {path}")
+                stats["failed"].append(host_path)
+                continue
+            if codec is not None and size > self.block_size//2:
+                names.add(path)
+                streamed.append((host_path, path))
+                continue
+            parent, name, _ = located
+            parent_path = "/".join(self.split_path(path)[:-1])
+            parent = parents.setdefault(parent_path, parent)#same object for every file of a directory
+            names.add(path)
+            inode = Inode(b"\x00", int(slots[len(planned)]))
+            inode.valid, inode.flags, inode.size, inode.name = True, 0, size, name
+            planned.append((host_path, parent, name, inode))
+        if not planned:
+            return self.import_streamed(streamed, stats, total, codec, progress)
+        small = [self.small_files and 0 < inode.size <= self.block_size//2 for _, _, _, inode in planned]#inline or tail packed
+        counts = [0 if is_small else self.pointer_blocks(-(-inode.size//self.block_size))+(-(-inode.size//self.block_size))
+                  for (_, _, _, inode), is_small in zip(planned, small)]
+        extents = self.allocate_extents(sum(counts))#one allocation for the batch, each file gets its pointer blocks then its data
+        if extents is None:
+            print("[-] Not enough space")
+            stats["failed"] += [host_path for host_path, _, _, _ in planned]
+            return False
+        reserved = [block for start, length in extents for block in range(start, start+length)]
+        written = []
+        pending = []
+        position = 0
+        try:
+            with WritePipeline(self.encrypt_pairs, self.disk.write_many) as pipeline:
+                for (host_path, parent, name, inode), count, is_small in zip(planned, counts, small):
+                    blocks = reserved[position:position+count]
+                    position += count
+                    if is_small:
+                        with open(host_path, "rb") as file:
+                            stored = self.store_small(inode, file.read(inode.size))
+                        if not stored and self.write_data(inode, host_path) == -1:
+                            stats["failed"].append(host_path)
+                            continue
+                    elif self.write_data(inode, host_path, blocks, pipeline, pending) == -1:
+                        stats["failed"].append(host_path)
+                        if pipeline.cancelled.is_set():
+                            raise PipelineCancelled("Import cancelled")
+                        continue
+                    written.append((host_path, parent, name, inode))
+                    stats["bytes"] += inode.size
+                    if progress is not None:
+                        progress(stats["files"]+len(written), total, stats["bytes"])
+                    elif (stats["files"]+len(written)) % 100 == 0:
+                        elapsed = time.perf_counter()-start
+                        print(f"[*] Importing files {stats['files']+len(written)}/{total}, {self.disk.to_humain_readable(stats['bytes'])} "
+                              f"({self.disk.to_humain_readable(stats['bytes']/elapsed if elapsed else 0)}/s)", end="\r")
+                if pending:
+                    self.discard_blocks([sector for sector, _ in pending])
+                    pipeline.submit(pending)
+        except (KeyboardInterrupt, PipelineCancelled) as e:
+            print(f"\n[-] Import cancelled: {e}")
+            self.free_blocks(reserved)
+            for _, _, _, inode in written:
+                self.free_data(inode)
+            stats["failed"] += [host_path for host_path, _, _, _ in written]
+            stats["bytes"] -= sum(inode.size for _, _, _, inode in written)
+            self.flush()
+            return False
+        self.free_blocks(reserved[position:])
+        for host_path, parent, name, inode in written:#data is on disk: the entries can point to it
+            if not self.link(parent, name, inode):
+                self.free_data(inode)
+                stats["failed"].append(host_path)
+                stats["bytes"] -= inode.size
+                continue
+            self.add_inode(inode)
+            stats["files"] += 1
+        self.update_superblock()
+        self.flush()
+        return self.import_streamed(streamed, stats, total, codec, progress)
+
+    def import_streamed(self, files:list, stats:dict, total:int, codec, progress=None)->bool:
+        """Compressed files of an import_batch ((host path, path) pairs), written with create_file, False if it was cancelled"""
+        for host_path, path in files:
+            try:
+                created = self.create_file(path, host_path, codec.name)
+            except KeyboardInterrupt:
+                print("\n[-] Import cancelled")
+                stats["failed"] += [host_path for host_path, _ in files[files.index((host_path, path)):]]
+                return False
+            if not created:
+                stats["failed"].append(host_path)
+                continue
+            stats["files"] += 1
+            stats["bytes"] += os.path.getsize(host_path)
+            if progress is not None:
+                progress(stats["files"], total, stats["bytes"])
+        return True
+    
     def find_free_data_block(self)->int:
         """Find free data block:
-        - will use bitmap to find free data block
-        - reverse inode position from data block position, if its deleted, return it
+        - start from the bitmap block (and bit) of the last allocation
+        - bitmap blocks without free bits are skipped with the summary (free_counts)
+        - search 64 bits at a time in the bitmap block
         """
-        #USE self.bitmap
-        for position in range(self.offset_data, self.number_of_blocks):#skip superblock, bitmap blocks, inode blocks and go to max data blocks (not sector)
-            #we divide by quotien to get the real block position
-            if position not in self.bitmap or self.bitmap[position] == 0:
-                self.xor_bitmap(position)
-                self.bitmap[position] = 1
-                return position
-        return None
+        bitmap_block_number = self.next_bitmap_block
+        if self.free_counts[bitmap_block_number-1] == 0:
+            candidates = np.flatnonzero(self.free_counts)+1#free or unknown
+            if len(candidates) == 0:
+                return None
+            after = candidates[candidates > bitmap_block_number]
+            bitmap_block_number = int(after[0] if len(after) else candidates[0])
+            self.next_free_bit = 0
+        bitmap_block = self.load_bitmap(bitmap_block_number)
+        bit = self.find_free_bit(bitmap_block, self.bitmap_bits(bitmap_block_number), self.next_free_bit)
+        if bit is None:#summary was wrong (or unknown and full)
+            self.free_counts[bitmap_block_number-1] = 0
+            self.save_summary(bitmap_block_number)
+            return self.find_free_data_block()
+        self.next_bitmap_block = bitmap_block_number
+        self.next_free_bit = bit+1
+        position = self.offset_data+(bitmap_block_number-1)*self.bits_per_bitmap_block+bit
+        self.set_bitmap(position, True)
+        return position
 
     def loading(self,action:str,size:int,ogsize:int,t1:float):
         """Loading bar"""
         percentage = round((ogsize-size)/ogsize*100)
         print(f"[*] {action} file, {self.disk.to_humain_readable(size)} remaining ({percentage}%)", end="\r")
 
-    def write_data(self, inode:Inode, path:str):
+    def reserve_blocks(self, size:int)->list:
+        """Reserve the blocks of size octets in contiguous extents: pointer blocks first, then data blocks (None: not enough space)"""
+        data_blocks = -(-size//self.block_size)
+        pointer_extents = self.allocate_extents(self.pointer_blocks(data_blocks))
+        data_extents = self.allocate_extents(data_blocks) if pointer_extents is not None else None
+        if data_extents is None:
+            if pointer_extents:
+                self.free_blocks([block for start, length in pointer_extents for block in range(start, start+length)])
+            return None
+        return [block for start, length in pointer_extents+data_extents for block in range(start, start+length)]
+
+    def write_data(self, inode:Inode, source, reserved:list=None, pipeline:WritePipeline=None, pending:list=None):
         """Write data to disk:
         - for 4 first data blocks, write data
         - if data > 4*self.block_size, write to indirect block
         - for indirect block, write pointers to data blocks
         - if data > 4*self.block_size+1024*self.block_size, write to double indirect block
         - for double indirect block, write pointers to indirect blocks
+        - blocks are reserved up front in contiguous extents (pointer blocks apart, before the data)
+        - the file is read here, batches are encrypted and written
+          by a WritePipeline (reading, encryption and disk writes overlap)
+        - on error or Ctrl+C the pipeline is cancelled and the allocated blocks are freed
+        source: path or binary file object (inode.size octets expected)
+        reserved: blocks planned by the caller (see reserve_blocks), pipeline/pending: shared by the files of a batch
+        (the caller submits the last pending blocks and closes the pipeline)
         """
         # ogsize = len(data)
         # t1 = time.time()
-        if os.path.getsize(path) > self.block_size*(4+1024+1024*1024):
+        self.pointer_cache.pop(inode.position, None)#the pointers change
+        size = inode.size
+        if size > self.block_size*(4+1024+1024*1024):
             print("[-] File too big")
             return -1
-        file = open(path, "rb")
-        for i in range(4):
-            data = file.read(self.block_size)
-            if not data:
-                break
-            if inode.direct[i] == 0:
-                inode.direct[i] = self.find_free_data_block()
-            self.write_sector(inode.direct[i], data)
-            # self.loading("Writing",len(data),ogsize,t1)
-        if data:
-            if inode.indirect == 0:
-                inode.indirect = self.find_free_data_block()
-            indirect_block = b""
-            for i in range(0, self.block_size, 4):
-                data = file.read(self.block_size)
-                if not data:
-                    break
+        data_blocks = -(-size//self.block_size)
+        if reserved is None:
+            reserved = self.reserve_blocks(size)
+            if reserved is None:
+                print("[-] Not enough space")
+                return -1
+        free_pointers = iter(reserved[:len(reserved)-data_blocks])
+        free_data = iter(reserved[len(reserved)-data_blocks:])
+        allocated = []#blocks found later (the file grew while being written)
+        def allocate(blocks=free_data):
+            pointer = next(blocks, None)
+            if pointer is None:
                 pointer = self.find_free_data_block()
-                indirect_block += pointer.to_bytes(4, byteorder="big")
-                self.write_sector(pointer, data)
-                # self.loading("Writing",len(data),ogsize,t1)
-            self.write_sector(inode.indirect, indirect_block)
-            if data:
-                try:
-                    if inode.double_indirect == 0:
-                        inode.double_indirect = self.find_free_data_block()
-                    double_indirect_block = b""
+                if pointer is None:
+                    raise OSError("No free data block left")
+                allocated.append(pointer)
+            return pointer
+        def allocate_pointer():
+            return allocate(free_pointers)
+        shared = pipeline is not None
+        if pending is None:
+            pending = []#blocks are sent to the pipeline by batches of batch_size
+        try:
+            with (open(source, "rb") if isinstance(source, str) else contextlib.nullcontext(source)) as file, \
+                    (contextlib.nullcontext(pipeline) if shared else WritePipeline(self.encrypt_pairs, self.disk.write_many)) as pipeline:
+                for i in range(4):
+                    data = file.read(self.block_size)
+                    if not data:
+                        break
+                    if inode.direct[i] == 0:
+                        inode.direct[i] = allocate()
+                    self.queue_sector(pending, inode.direct[i], data, pipeline)
+                    # self.loading("Writing",len(data),ogsize,t1)
+                if data:
+                    if inode.indirect == 0:
+                        inode.indirect = allocate_pointer()
+                    indirect_block = b""
                     for i in range(0, self.block_size, 4):
+                        data = file.read(self.block_size)
                         if not data:
                             break
-                        indirect_pointer = self.find_free_data_block()
-                        double_indirect_block += indirect_pointer.to_bytes(4, byteorder="big")
-                        indirect_block = b""
-                        for j in range(0, self.block_size, 4):
-                            data = file.read(self.block_size)
+                        pointer = allocate()
+                        indirect_block += pointer.to_bytes(4, byteorder="big")
+                        self.queue_sector(pending, pointer, data, pipeline)
+                        # self.loading("Writing",len(data),ogsize,t1)
+                    self.queue_sector(pending, inode.indirect, indirect_block, pipeline)
+                    if data:
+                        if inode.double_indirect == 0:
+                            inode.double_indirect = allocate_pointer()
+                        double_indirect_block = b""
+                        for i in range(0, self.block_size, 4):
                             if not data:
                                 break
-                            pointer = self.find_free_data_block()
-                            indirect_block += pointer.to_bytes(4, byteorder="big")
-                            self.write_sector(pointer, data)
-                            # self.loading("Writing",len(data),ogsize,t1)
-                        self.write_sector(indirect_pointer, indirect_block)
-                    self.write_sector(inode.double_indirect, double_indirect_block)
-                except KeyboardInterrupt:
-                    print("[-] Cancelled writing file")
-                    return -1
+                            indirect_pointer = allocate_pointer()
+                            double_indirect_block += indirect_pointer.to_bytes(4, byteorder="big")
+                            indirect_block = b""
+                            for j in range(0, self.block_size, 4):
+                                data = file.read(self.block_size)
+                                if not data:
+                                    break
+                                pointer = allocate()
+                                indirect_block += pointer.to_bytes(4, byteorder="big")
+                                self.queue_sector(pending, pointer, data, pipeline)
+                                # self.loading("Writing",len(data),ogsize,t1)
+                            self.queue_sector(pending, indirect_pointer, indirect_block, pipeline)
+                        self.queue_sector(pending, inode.double_indirect, double_indirect_block, pipeline)
+                if pending and not shared:
+                    self.discard_blocks([sector for sector, _ in pending])
+                    pipeline.submit(pending)
+        except (KeyboardInterrupt, PipelineCancelled, OSError) as e:
+            print("[-] Cancelled writing file" if isinstance(e, KeyboardInterrupt) else f"[-] Error writing file: {e}")
+            if shared and isinstance(e, KeyboardInterrupt):
+                pipeline.cancel()#the whole batch stops
+            self.free_blocks(reserved+allocated)
+            return -1
+        self.free_blocks(list(free_pointers)+list(free_data))#the file shrank while being written
         return 1
     
     def delete_file(self, filename:str):
         """Delete file from disk:
-        - Search for file in directory (in memory)
-        - Read inode
+        - Search for file (root directory in memory, paths through their directories)
+        - Read inode (directories: only when empty)
         - Update bitmap
         - Update directory
         - Update inode
         """
-        inode = self.find_file(filename)
-        if inode is None:
+        located = self.locate(filename)
+        if located is None or located[2] is None:
             return False
-        for i in range(4):
-            if inode.direct[i] == 0:
-                break
-            self.xor_bitmap(inode.direct[i])
-            self.bitmap[inode.direct[i]] = 0
-        if inode.indirect != 0:
-            indirect_block = self.read_sector(inode.indirect)
-            for i in range(0, self.block_size, 4):
-                pointer = int.from_bytes(indirect_block[i:i+4], byteorder="big")
-                if pointer == 0:
-                    break
-                self.xor_bitmap(pointer)
-                self.bitmap[pointer] = 0
-            self.xor_bitmap(inode.indirect)
-            self.bitmap[inode.indirect] = 0
-        if inode.double_indirect != 0:
-            double_indirect_block = self.read_sector(inode.double_indirect)
-            for i in range(0, self.block_size, 4):
-                indirect_pointer = int.from_bytes(double_indirect_block[i:i+4], byteorder="big")
-                if pointer == 0:
-                    break
-                indirect_block = self.read_sector(indirect_pointer)
-                for j in range(0, self.block_size, 4):
-                    pointer = int.from_bytes(indirect_block[j:j+4], byteorder="big")
-                    if pointer == 0:
-                        break
-                    self.xor_bitmap(pointer)
-                    self.bitmap[pointer] = 0
-                self.xor_bitmap(indirect_pointer)
-                self.bitmap[indirect_pointer] = 0
-            self.xor_bitmap(inode.double_indirect)
-            self.bitmap[inode.double_indirect] = 0
+        parent, name, inode = located
+        if inode.is_directory() and next(self.directory_entries(inode), None) is not None:
+            print(f"[-] Directory not empty: {filename}")
+            return False
+        self.free_data(inode)
         inode.valid = False
-        self.update_node(inode)
-        del self.directory[filename]
+        self.remove_inode(inode)
+        self.unlink(parent, name)
         self.update_superblock()
         self.save_bitmap()
         return True
     
     def rename_file(self, oldname:str, newname:str):
         """Rename file:
-        - Search for file in directory (in memory)
-        - Update directory
-        - Update inode
+        - Search for file (paths: the file can move to another directory)
+        - Update directories (entry removed from the old one, added to the new one)
+        - Update inode (name, nested flag)
         """
-        inode = self.find_file(oldname)
-        if inode is None:
+        located = self.locate(oldname)
+        if located is None or located[2] is None:
             print("File not found")
             return False
-        inode.name = newname
+        parent, name, inode = located
+        target = self.locate(newname)
+        if target is None or target[2] is not None or not self.valid_name(target[0], target[1]):
+            print(f"[-] Cannot rename to {newname}")
+            return False
+        new_parent, new_name, _ = target
+        old_parts = self.split_path(oldname)
+        if inode.is_directory() and self.split_path(newname)[:len(old_parts)] == old_parts:
+            print("[-] Cannot move a directory inside itself")
+            return False
+        self.unlink(parent, name)
+        if new_parent is not None and parent is not None and new_parent.position == parent.position:
+            new_parent = parent#same directory: the bucket count is already up to date
+        if not self.link(new_parent, new_name, inode):
+            self.link(parent, name, inode)
+            return False
         self.update_node(inode)
-        self.directory[newname] = inode
-        del self.directory[oldname]
+        if parent is None or new_parent is None:
+            self.update_superblock()#number of root entries
+        self.save_bitmap()
         return True
     
+    def write_at(self, filename:str, offset:int, data:bytes)->bool:
+        """Overwrite a part of a file (in place):
+        - only the blocks covering offset..offset+len(data) are written (first/last ones read, modified and written again)
+        - blocks are allocated only after the end of the file (a gap after the end is filled with 0s)
+        - pointer blocks changed (or created) are written, Inode.size is updated with update_node
+        """
+        if offset < 0:
+            raise ValueError(f"Invalid offset: {offset}")
+        inode = self.find_file(filename)
+        if inode is None or inode.is_directory():
+            print("File not found")
+            return False
+        if not data:
+            return True
+        if inode.flags & INODE_COMPRESSED:
+            return self.rewrite_compressed(filename, inode, offset, bytes(data), max(inode.size, offset+len(data)))
+        if offset > inode.size:#no hole in a file: 0s up to offset
+            data = b"\x00"*(offset-inode.size)+bytes(data)
+            offset = inode.size
+        end = offset+len(data)
+        if end > self.block_size*(4+1024+1024*1024):
+            print("[-] File too big")
+            return False
+        if inode.is_small():
+            content = bytearray(self.read_small(inode))
+            content[offset:end] = data
+            if self.store_small(inode, content):
+                self.update_node(inode)
+                self.save_bitmap()
+                return True
+            if not self.unpack_small(inode):#too big now: the blocks are written below
+                return False
+        bs = self.block_size
+        first, last = offset//bs, (end-1)//bs
+        blocks = -(-inode.size//bs)#data blocks of the file
+        pointers = self.file_pointers(inode)
+        targets = [self.pointer_at(inode, index, pointers) for index in range(first, min(last+1, blocks))]
+        saved = (list(inode.direct), inode.indirect, inode.double_indirect)
+        modified = {}#pointer block: content
+        allocated = []
+        if last+1 > blocks:
+            extents = self.allocate_extents(last+1-max(first, blocks))
+            if extents is None:
+                print("[-] Not enough space")
+                return False
+            allocated = [block for start, length in extents for block in range(start, start+length)]
+            try:
+                for index, block in zip(range(max(first, blocks), last+1), allocated):
+                    self.set_pointer(inode, index, block, modified, allocated)
+            except OSError as e:
+                print(f"[-] Error writing file: {e}")
+                inode.direct, inode.indirect, inode.double_indirect = saved
+                self.free_blocks(allocated)
+                return False
+            targets += allocated[:last+1-max(first, blocks)]
+        pairs = []
+        for index, block in zip(range(first, last+1), targets):
+            start = max(offset, index*bs)
+            stop = min(end, (index+1)*bs)
+            if stop-start == bs:
+                content = data[start-offset:stop-offset]
+            else:#partial block: the octets after the end of the file are 0s
+                valid = min(max(inode.size-index*bs, 0), bs)
+                content = bytearray(bytes(self.read_sector(block))[:valid].ljust(bs, b"\x00") if valid else bs)
+                content[start-index*bs:stop-index*bs] = data[start-offset:stop-offset]
+            pairs.append((block, content))
+        self.write_sectors(pairs+list(modified.items()))
+        self.pointer_cache.pop(inode.position, None)
+        inode.size = max(inode.size, end)
+        self.update_node(inode)
+        self.save_bitmap()
+        return True
+
+    def truncate(self, filename:str, size:int)->bool:
+        """Change the size of a file:
+        - shrink: the data blocks after size and the pointer blocks not needed anymore are freed,
+          the pointers after the end are cleared (only the last pointer blocks are written)
+        - grow: 0s are written after the end (write_at)
+        - small files: their data is stored again (inline or tail packed), size 0 frees it
+        - compressed files are written again (rewrite_compressed)
+        """
+        if size < 0:
+            raise ValueError(f"Invalid size: {size}")
+        inode = self.find_file(filename)
+        if inode is None or inode.is_directory():
+            print("File not found")
+            return False
+        if inode.flags & INODE_COMPRESSED:
+            return self.rewrite_compressed(filename, inode, 0, b"", size)
+        if inode.is_small() and size <= inode.size:
+            if size:
+                self.store_small(inode, self.read_small(inode)[:size])
+            else:
+                self.free_small(inode)
+                inode.size = 0
+            self.update_node(inode)
+            self.save_bitmap()
+            return True
+        if size > inode.size:
+            for offset in range(inode.size, size, self.batch_size*self.block_size):#bounded memory
+                if not self.write_at(filename, offset, b"\x00"*min(self.batch_size*self.block_size, size-offset)):
+                    return False
+            return True
+        bs = self.block_size
+        per_block = bs//4
+        blocks, keep = -(-inode.size//bs), -(-size//bs)
+        pointers = self.file_pointers(inode)
+        freed = [self.pointer_at(inode, index, pointers) for index in range(keep, blocks)]
+        modified = {}
+        for index in range(keep, 4):
+            inode.direct[index] = 0
+        if inode.indirect:
+            if keep <= 4:
+                freed.append(inode.indirect)
+                inode.indirect = 0
+            elif keep < 4+per_block:
+                self.load_pointer_block(inode.indirect, modified)[4*(keep-4):] = bytes(4*(per_block-keep+4))
+        if inode.double_indirect:
+            children = self.read_pointer_block(inode.double_indirect)
+            rest = keep-4-per_block#data blocks kept under the double indirect block
+            if rest <= 0:
+                freed += children+[inode.double_indirect]
+                inode.double_indirect = 0
+            else:
+                needed = -(-rest//per_block)
+                freed += children[needed:]
+                self.load_pointer_block(inode.double_indirect, modified)[4*needed:] = bytes(4*(per_block-needed))
+                if rest%per_block:
+                    self.load_pointer_block(children[needed-1], modified)[4*(rest%per_block):] = bytes(4*(per_block-rest%per_block))
+        if modified:
+            self.write_sectors(list(modified.items()))
+        self.pointer_cache.pop(inode.position, None)
+        inode.size = size
+        self.update_node(inode)
+        self.free_blocks(freed)
+        self.save_bitmap()
+        return True
+
+    def rewrite_compressed(self, filename:str, inode:Inode, offset:int, data:bytes, size:int)->bool:
+        """write_at/truncate of a compressed file: its frames are not changed in place, the file is streamed again
+        with the same codec (data at offset, cut or filled with 0s up to size), the old blocks are freed on close"""
+        codec = self.frame_table(inode, self.file_pointers(inode))[0]
+        step = self.batch_size*self.block_size
+        try:
+            with self.open(filename, "wb", codec.name) as file:
+                for start in range(0, size, step):
+                    chunk = bytearray(self.read_at(inode, start, min(step, size-start)).ljust(min(step, size-start), b"\x00"))
+                    first, last = max(start, offset), min(start+len(chunk), offset+len(data))
+                    if first < last:
+                        chunk[first-start:last-start] = data[first-offset:last-offset]
+                    file.write(chunk)
+        except OSError as e:
+            print(f"[-] Error writing file: {e}")
+            return False
+        return True
+
+    def load_pointer_block(self, block:int, modified:dict)->bytearray:
+        """Pointer block to modify (written by the caller with the other modified ones)"""
+        if block not in modified:
+            modified[block] = bytearray(bytes(self.read_sector(block)).ljust(self.block_size, b"\x00"))
+        return modified[block]
+
+    def new_pointer_block(self, modified:dict, allocated:list)->int:
+        block = self.find_free_data_block()
+        if block is None:
+            raise OSError("No free data block left")
+        allocated.append(block)
+        modified[block] = bytearray(self.block_size)
+        return block
+
+    def set_pointer(self, inode:Inode, index:int, pointer:int, modified:dict, allocated:list):
+        """Set the pointer of the index-th data block of a file, missing pointer blocks are allocated (added to allocated)"""
+        if index < 4:
+            inode.direct[index] = pointer
+            return
+        index -= 4
+        per_block = self.block_size//4
+        if index < per_block:
+            if inode.indirect == 0:
+                inode.indirect = self.new_pointer_block(modified, allocated)
+            block = inode.indirect
+        else:
+            index -= per_block
+            if inode.double_indirect == 0:
+                inode.double_indirect = self.new_pointer_block(modified, allocated)
+            double_indirect = self.load_pointer_block(inode.double_indirect, modified)
+            j = 4*(index//per_block)
+            block = int.from_bytes(double_indirect[j:j+4], byteorder="big")
+            if block == 0:
+                block = self.new_pointer_block(modified, allocated)
+                double_indirect[j:j+4] = block.to_bytes(4, byteorder="big")
+            index %= per_block
+        self.load_pointer_block(block, modified)[4*index:4*index+4] = pointer.to_bytes(4, byteorder="big")
+
     def reset_disk(self):
         """Fast reset so just write 0s to superblock+bitmap+inode blocks"""
-        try:
-            stop = self.offset_data
-            for i in range(stop):
-                self.write_sector(i, b"\x00"*self.block_size)
-                #print(f"[*] Resetting disk, {i}/{stop} ({round(i/(stop)*100)}%)", end="\r")
-        except KeyboardInterrupt:
-            print("[+] Skipped some blocks")
-        self.directory = {}
-        self.update_superblock()
-        self.bitmap = {}
-        self.hot_bitmap_blocks = {}
-        self.init_fs(force=True)
+        if self.mode == "crypt":#the reset volume uses the cipher chosen for new volumes
+            self.crypt_module = CIPHERS[self.cipher].from_key(self.crypt_module.password, self.crypt_module.pin)
+        self.journal_ready = False#the new metadata is written in place
+        self.checkpoint_pending = {}
+        self.init_fs(force=True)#new superblock, 0s in bitmap/summary/inode blocks (dense bitmap layout), empty journal
+        self.open_journal()
+        self.load_summary()
+        self.pointer_cache.clear()
+        self.directory = self.read_inodes()
+        self.setup_cipher()
         return
     
     def calculate_used_space(self):
@@ -515,11 +2424,28 @@ class FileSystem:
         """Read test"""
         print("SuperBlock:", self.read_sector(0))
         print("1st bitmap block:", self.read_sector(1))
-        print("1st inode block:", self.read_sector(self.number_of_bitmap_blocks+1), self.number_of_bitmap_blocks+1)
+        print("1st inode block:", self.read_sector(self.offset_inodes), self.offset_inodes)
         print("1st data block:", self.read_sector(self.offset_data))
         return
 
 if __name__ == "__main__":
+    def pipe(command:str, filename:str):
+        """python FS.py put|append <file> < data, python FS.py get <file> > data
+        (messages and prompts go to stderr, stdout only gets the file)"""
+        output = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            instance = FileSystem(0)
+            try:
+                if command == "get":
+                    with instance.open(filename, "rb") as file:
+                        shutil.copyfileobj(file, output, instance.batch_size*instance.block_size)
+                    output.flush()
+                else:
+                    with instance.open(filename, "wb" if command == "put" else "ab") as file:
+                        shutil.copyfileobj(sys.stdin.buffer, file, instance.batch_size*instance.block_size)
+            finally:
+                instance.close()
+
     def main():
         skip = 0
         instance = FileSystem(skip)
@@ -533,13 +2459,24 @@ if __name__ == "__main__":
             print(f"inodes: {len(instance.directory)}/{total_inodes} ({round(len(instance.directory)/total_inodes*100)}%)")
             print(f"Used space: {instance.disk.to_humain_readable(instance.calculate_used_space())}")
             if DEBUG:print(f"blocks: BitMap: {instance.number_of_bitmap_blocks}, Inode: {instance.number_of_inode_blocks}")
-            print("\nOptions: [list, read <file>, dump <file>, create <file>, delete <file>, rename <old> <new>, reset, exit, benchmark]")
+            if DEBUG:print(f"cache: {instance.cache.stats()}")
+            print("\nOptions: [list [dir], read <file>, dump <file>, create <file>, import [dir], mkdir <dir>, delete <file>, rename <old> <new>, passwd, reset, exit, benchmark, benchmark inodes]")
+            print("(files can be paths: dir/sub/file)")
             command = input("> ")
-            if command == "list":
+            if command == "list" or command.startswith("list "):
+                path = command.split(" ")[1] if " " in command else ""
+                entries = instance.list_directory(path)
+                if entries is None:
+                    print("Directory not found")
+                    input("Press Enter to continue...")
+                    continue
                 print("Files:")
-                for filename in instance.directory:
-                    print(f"  {filename} ({instance.disk.to_humain_readable(instance.directory[filename].size)}) \
-                        {instance.directory[filename].direct} {instance.directory[filename].indirect} {instance.directory[filename].double_indirect}")
+                for filename, inode in entries.items():
+                    if inode.is_directory():
+                        print(f"  {filename}/")
+                        continue
+                    print(f"  {filename} ({instance.disk.to_humain_readable(inode.size)}) \
+                        {inode.direct} {inode.indirect} {inode.double_indirect}")
             elif command.startswith("read "):
                 filename = command.split(" ")[1]
                 for data in instance.read_file(filename):
@@ -566,6 +2503,18 @@ if __name__ == "__main__":
                     print("File created successfully")
                 else:
                     print("Failed to create file")
+            elif command == "import" or command.startswith("import "):
+                destination = command.split(" ")[1] if " " in command else ""
+                path = askdirectory()
+                if path:
+                    stats = instance.create_files(path, destination)
+                    for failed in stats["failed"]:
+                        print(f"  failed: {failed}")
+            elif command.startswith("mkdir "):
+                if instance.mkdir(command.split(" ")[1]):
+                    print("Directory created successfully")
+                else:
+                    print("Failed to create directory")
             elif command.startswith("delete ") or command.startswith("del "):
                 filename = command.split(" ")[1]
                 if instance.delete_file(filename):
@@ -579,11 +2528,21 @@ if __name__ == "__main__":
                     print("File renamed successfully")
                 else:
                     print("File not found")
+            elif command == "passwd":
+                try:
+                    instance.change_passphrase(input("Current password: "), input("Current PIN: "), input("New password: "), input("New PIN: "))
+                    print("Password changed")
+                except Exception as e:
+                    print(f"[-] {e}")
             elif command == "reset":
                 instance.reset_disk()
                 print("Disk reset")
             elif command == "exit":
+                instance.close()
                 break
+            elif command == "benchmark inodes":
+                for name, value in benchmark_inodes().items():
+                    print(f"    - {name}: {round(value):,}")
             elif command == "benchmark":
                 #speed for 5Mo file read/write + test with and without crypt
                 if not input("This will break the filesystem, are you sure? (y/n) ").startswith("y"):continue
@@ -636,4 +2595,7 @@ if __name__ == "__main__":
             else:
                 print("Invalid command")
             input("Press Enter to continue...")
-    main()
\ No newline at end of file
+    if len(sys.argv) == 3 and sys.argv[1] in ("put", "append", "get"):
+        pipe(sys.argv[1], sys.argv[2])
+    else:
+        main()
\ No newline at end of file
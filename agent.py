@@ -0,0 +1,99 @@
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+SOCKET_PATH = os.environ.get("PYCRYPT_AGENT", os.path.join(os.path.expanduser("~"), ".pycrypt-agent.sock"))
+DEFAULT_TTL = 15 * 60  # seconds
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    """One JSON request per connection:
+    - {"op": "get", "volume": hex} -> {"key": hex or null}
+    - {"op": "put", "volume": hex, "key": hex, "ttl": seconds}
+    - {"op": "forget", "volume": hex or null}
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        server = self.server
+        with server.lock:
+            now = time.time()
+            for volume in [v for v, (_, expire) in server.keys.items() if expire < now]:
+                del server.keys[volume]
+            response = {}
+            if request.get("op") == "get":
+                entry = server.keys.get(request.get("volume"))
+                response["key"] = entry[0] if entry else None
+            elif request.get("op") == "put":
+                ttl = request.get("ttl") or server.ttl
+                server.keys[request["volume"]] = (request["key"], now + ttl)
+            elif request.get("op") == "forget":
+                if request.get("volume") is None:
+                    server.keys.clear()
+                else:
+                    server.keys.pop(request["volume"], None)
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class Agent(socketserver.ThreadingUnixStreamServer):
+    """Unlock agent: keeps unlocked master keys in memory for ttl seconds,
+    so the KDF only runs once per session (CLI invocations, GUI restarts)"""
+    def __init__(self, path: str = SOCKET_PATH, ttl: int = DEFAULT_TTL):
+        if os.path.exists(path):
+            os.remove(path)
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        old_umask = os.umask(0o177)#socket only accessible by the user
+        try:
+            super().__init__(path, AgentHandler)
+        finally:
+            os.umask(old_umask)
+
+
+def request(message: dict, path: str = SOCKET_PATH) -> dict:
+    """Send a request to the agent, None if no agent is running"""
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(2)
+            client.connect(path)
+            client.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            return json.loads(client.makefile("rb").readline())
+    except (OSError, ValueError):
+        return None
+
+
+def get_key(volume_id: bytes) -> bytes:
+    response = request({"op": "get", "volume": volume_id.hex()})
+    if not response or not response.get("key"):
+        return None
+    return bytes.fromhex(response["key"])
+
+
+def put_key(volume_id: bytes, key: bytes, ttl: int = None):
+    request({"op": "put", "volume": volume_id.hex(), "key": key.hex(), "ttl": ttl})
+
+
+def forget(volume_id: bytes = None):
+    request({"op": "forget", "volume": volume_id.hex() if volume_id else None})
+
+
+if __name__ == "__main__":
+    ttl = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TTL
+    agent = Agent(SOCKET_PATH, ttl)
+    print(f"[*] Agent listening on {SOCKET_PATH} (ttl: {ttl}s)")
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.server_close()
+        os.remove(SOCKET_PATH)
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import threading
+
+
+class BlockCache:
+    """Write-back LRU cache of decrypted blocks
+    - max_bytes: memory budget (pinned blocks are never evicted)
+    - dirty blocks are written with write_back(pairs) when evicted or on flush()
+    - hits/misses counters
+    """
+    def __init__(self, write_back, max_bytes: int = 32 * 1024 ** 2):
+        self.write_back = write_back
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pinned_entries = {}
+        self.pinned = []#ranges of pinned blocks
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def is_pinned(self, block: int) -> bool:
+        return any(block in blocks for blocks in self.pinned)
+
+    def pin(self, blocks: range):
+        """Never evict these blocks (superblock, bitmap and inode blocks...)"""
+        with self.lock:
+            self.pinned.append(blocks)
+            for block in [block for block in self.entries if block in blocks]:
+                self.pinned_entries[block] = self.entries.pop(block)
+
+    def get(self, block: int):
+        """Cached block or None"""
+        with self.lock:
+            data = self.pinned_entries.get(block)
+            if data is None:
+                data = self.entries.get(block)
+                if data is not None:
+                    self.entries.move_to_end(block)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return data
+
+    def put(self, block: int, data, dirty: bool = False):
+        """Add/replace a block, dirty blocks are written back later"""
+        with self.lock:
+            self._remove(block)
+            if self.is_pinned(block):
+                self.pinned_entries[block] = data
+            else:
+                self.entries[block] = data
+            self.size += len(data)
+            if dirty:
+                self.dirty.add(block)
+            self._evict()
+
+    def mark_dirty(self, block: int):
+        """The cached block was modified in place"""
+        with self.lock:
+            self.dirty.add(block)
+
+    def discard(self, blocks):
+        """Forget blocks (without writing them), they are about to be overwritten"""
+        with self.lock:
+            for block in blocks:
+                self._remove(block)
+                self.dirty.discard(block)
+
+    def flush(self):
+        """Write all dirty blocks"""
+        with self.lock:
+            if not self.dirty:
+                return
+            pairs = [(block, self.pinned_entries.get(block, self.entries.get(block))) for block in sorted(self.dirty)]
+            self.dirty.clear()
+            self.write_back(pairs)
+
+    def clear(self):
+        """Drop everything (dirty blocks included)"""
+        with self.lock:
+            self.entries.clear()
+            self.pinned_entries.clear()
+            self.dirty.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "size": self.size,
+            "dirty": len(self.dirty),
+        }
+
+    def _remove(self, block: int):
+        data = self.pinned_entries.pop(block, None)
+        if data is None:
+            data = self.entries.pop(block, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def _evict(self):
+        evicted = []
+        while self.size > self.max_bytes and self.entries:
+            block, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+            if block in self.dirty:
+                self.dirty.discard(block)
+                evicted.append((block, data))
+        if evicted:
+            self.write_back(evicted)
@@ -0,0 +1,53 @@
+import lzma
+import zlib
+import numpy as np
+
+
+class ZlibCodec:
+    """zlib (deflate): fast, good on text and logs"""
+    codec_id = 1
+    name = "zlib"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class LzmaCodec:
+    """lzma (raw LZMA2 stream, no xz container): smaller output, slower"""
+    codec_id = 2
+    name = "lzma"
+    filters = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+
+#codecs of compressed files, a codec is a class with codec_id (1 octet, stored in the file), name, compress and decompress
+#(add one here to use it, its codec_id must never change)
+CODECS = {codec.name: codec for codec in (ZlibCodec, LzmaCodec)}
+CODEC_IDS = {codec.codec_id: codec for codec in CODECS.values()}
+
+
+def entropy(data: bytes, sample: int = 4096) -> float:
+    """Shannon entropy (bits per octet, 0 to 8) of about sample octets spread over data"""
+    octets = np.frombuffer(data, dtype=np.uint8)
+    if len(octets) == 0:
+        return 0.0
+    octets = octets[::max(len(octets)//sample, 1)]
+    counts = np.bincount(octets, minlength=256)
+    p = counts[counts > 0]/len(octets)
+    return float(-(p*np.log2(p)).sum())
+
+
+def compressible(data: bytes, threshold: float = 7.5) -> bool:
+    """Quick probe before compressing: already compressed/encrypted data is close to 8 bits per octet"""
+    return entropy(data) < threshold
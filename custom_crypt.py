@@ -2,19 +2,163 @@ import hashlib
 import os
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from argon2 import PasswordHasher
 import random
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 # import time
 
+NOISE_LEGACY = 0  # one random.randint per byte (original volumes)
+NOISE_CTR = 1  # AES-CTR keystream, one native call per sector
 
-class SectorCrypt:
-    def __init__(self, password: str, pin: str):
+
+class PermutationCache:
+    """LRU cache of (forward, inverse) shuffle permutations keyed by sector number.
+    - max_bytes: memory cap for the index arrays
+    - pinned sectors are never evicted (superblock, bitmap, inode blocks...)
+    - thread safe (the write pipeline encrypts while the caller decrypts metadata)
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 ** 2):
+        self.lock = threading.RLock()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pinned = set()
+        self.pinned_entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sector_number: int, length: int):
+        with self.lock:
+            entry = self.pinned_entries.get(sector_number)
+            if entry is None:
+                entry = self.entries.get(sector_number)
+                if entry is not None:
+                    self.entries.move_to_end(sector_number)
+            if entry is None or len(entry[0]) != length:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def put(self, sector_number: int, entry):
+        with self.lock:
+            self.discard(sector_number)
+            if sector_number in self.pinned:
+                self.pinned_entries[sector_number] = entry
+            else:
+                self.entries[sector_number] = entry
+            self.size += entry[0].nbytes + entry[1].nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                forward, inverse = self.entries.popitem(last=False)[1]
+                self.size -= forward.nbytes + inverse.nbytes
+
+    def discard(self, sector_number: int):
+        with self.lock:
+            entry = self.pinned_entries.pop(sector_number, None) or self.entries.pop(sector_number, None)
+            if entry is not None:
+                self.size -= entry[0].nbytes + entry[1].nbytes
+
+    def pin(self, sector_numbers):
+        """Never evict these sectors (their permutation is still built lazily)"""
+        with self.lock:
+            for sector_number in sector_numbers:
+                self.pinned.add(sector_number)
+                if sector_number in self.entries:
+                    self.pinned_entries[sector_number] = self.entries.pop(sector_number)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pinned_entries.clear()
+            self.size = 0
+
+
+class SectorCipher:
+    """Common interface of the sector ciphers
+    - cipher_id: stored in the superblock to pick the cipher at mount
+    - encrypt_sector/decrypt_sector: one sector
+    - encrypt_sectors/decrypt_sectors: a run (start_sector, data) or a list of (sector, data) pairs
+    - password/pin: derived key and hashed PIN, enough to rebuild the cipher with from_key
+    """
+    cipher_id = None
+    name = None
+
+    @classmethod
+    def from_key(cls, key: bytes, pin: bytes, **options):
+        raise NotImplementedError
+
+    def options(self) -> dict:
+        """Keyword arguments of from_key to rebuild the same cipher (in a worker process)"""
+        return {}
+
+    def pin_sectors(self, sector_numbers):
+        """Hint: these sectors are hot metadata"""
+        return
+
+    def encrypt_sector(self, sector_number: int, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decrypt_sector(self, sector_number: int, data: bytes) -> bytes:
+        """data can be any buffer (memoryview of a mapped disk...)"""
+        raise NotImplementedError
+
+    def encrypt_sectors(self, sectors, data: bytes = None, sector_size: int = 4096):
+        """Encrypt a run of sectors (start_sector, data) or a list of (sector, data) pairs"""
+        if not isinstance(sectors, int):
+            return self._batch(sectors, self.encrypt_sectors)
+        if len(data) % sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {sector_size} bytes")
+        return b"".join(self.encrypt_sector(sectors + i, data[i*sector_size:(i+1)*sector_size])
+                        for i in range(len(data) // sector_size))
+
+    def decrypt_sectors(self, sectors, data: bytes = None, sector_size: int = 4096):
+        """Decrypt a run of sectors (start_sector, data) or a list of (sector, data) pairs"""
+        if not isinstance(sectors, int):
+            return self._batch(sectors, self.decrypt_sectors)
+        if len(data) % sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {sector_size} bytes")
+        data = memoryview(data)
+        return b"".join(self.decrypt_sector(sectors + i, data[i*sector_size:(i+1)*sector_size])
+                        for i in range(len(data) // sector_size))
+
+    def _batch(self, pairs, method) -> list:
+        """Split (sector, data) pairs in runs of contiguous sectors of the same size and process each run in one call"""
+        result = []
+        run_start, run = None, []
+        for sector_number, data in list(pairs) + [(None, b"")]:
+            if run and (sector_number != run_start + len(run) or len(data) != len(run[0])):
+                sector_size = len(run[0])
+                output = method(run_start, b"".join(run), sector_size)
+                result += [output[i:i+sector_size] for i in range(0, len(output), sector_size)]
+                run = []
+            if sector_number is None:
+                break
+            if not run:
+                run_start = sector_number
+            run.append(data)
+        return result
+
+
+class SectorCrypt(SectorCipher):
+    """AES ECB + byte shuffle + noise (original format)"""
+    cipher_id = 0
+    name = "sectorcrypt"
+
+    def __init__(self, password: str, pin: str, noise_version: int = NOISE_CTR, permutation_cache_bytes: int = 64 * 1024 ** 2):
         """
         Initialize the SectorCrypt with a password and a PIN (acting as a salt).
         
         :param password: User-provided password.
         :param pin: User-provided PIN code (used as the salt).
+        :param noise_version: NOISE_CTR (default) or NOISE_LEGACY to decode volumes written with the random based noise.
+        :param permutation_cache_bytes: memory cap of the shuffle permutation cache.
         """
+        self.noise_version = noise_version
+        self.permutations = PermutationCache(permutation_cache_bytes)
         self.raw_password = password
         self.pin = pin.encode("utf-8")  # PIN as bytes
         self.pin = hashlib.shake_256(self.pin).digest(16)  # Truncate to 16 bytes
@@ -27,7 +171,32 @@ class SectorCrypt:
             salt_len=len(self.pin),
         )
         self.password = self._derive_password()
+        self._init_ciphers()
+
+    @classmethod
+    def from_key(cls, key: bytes, pin: bytes, noise_version: int = NOISE_CTR, permutation_cache_bytes: int = 64 * 1024 ** 2):
+        """Build a SectorCrypt from an already derived key and hashed PIN (no Argon2)"""
+        self = cls.__new__(cls)
+        self.noise_version = noise_version
+        self.permutations = PermutationCache(permutation_cache_bytes)
+        self.raw_password = None
+        self.pin = pin
+        self.ph = None
+        self.password = key
+        self._init_ciphers()
+        return self
+
+    def _init_ciphers(self):
         self.aes_module = AES.new(self.password, AES.MODE_ECB)
+        self.noise_key = hashlib.sha256(self.password + self.pin).digest()#separate key for the keystream
+
+    def options(self) -> dict:
+        return {"noise_version": self.noise_version, "permutation_cache_bytes": self.permutations.max_bytes}
+
+    def pin_sectors(self, sector_numbers):
+        """Keep the permutations of these sectors (within half of the cache budget)"""
+        sector_numbers = list(sector_numbers)[:self.permutations.max_bytes // 2 // (4096 * 4)]
+        self.permutations.pin(sector_numbers)
 
     def _derive_password(self) -> bytes:
         """
@@ -52,39 +221,214 @@ class SectorCrypt:
             data = pad(data, AES.block_size)
         encrypted_data = self.aes_module.encrypt(data)
         seed = self._generate_seed(sector_number)
-        shuffled_data = self._shuffle_bytes(seed, encrypted_data)
-        noisy_data = self._noise(seed, shuffled_data)
+        shuffled_data = self._shuffle_bytes(sector_number, seed, encrypted_data)
+        noisy_data = self._noise(sector_number, seed, shuffled_data)
         if len(noisy_data) != len(data):
             raise ValueError("Data length changed during encryption!")
         return noisy_data
 
     def decrypt_sector(self, sector_number: int, data: bytes) -> bytes:
-        """Reverse noise, unshuffle, and decrypt a sector."""
+        """Reverse noise, unshuffle, and decrypt a sector.
+        - data can be any buffer (memoryview of a mapped disk...)
+        """
         seed = self._generate_seed(sector_number)
-        unnoised_data = self._noise(seed, data)
-        unshuffled_data = self._shuffle_bytes(seed, unnoised_data, reverse=True)
+        unnoised_data = self._noise(sector_number, seed, data)
+        forward, inverse = self._permutation(sector_number, seed, len(unnoised_data))
+        unshuffled_data = memoryview(np.frombuffer(unnoised_data, dtype=np.uint8)[inverse])
         decrypted_data = self.aes_module.decrypt(unshuffled_data)
         if len(decrypted_data) % 16 != 0:
             decrypted_data = unpad(decrypted_data, AES.block_size)
         return decrypted_data
 
-    def _shuffle_bytes(self, seed: int, data: bytes, reverse=False) -> bytes:
-        """Shuffle or unshuffle bytes deterministically based on seed."""
-        if not reverse:
-            data = bytearray(data)
-            random.Random(seed).shuffle(data)
-            return bytes(data)
-        indexes = list(range(len(data)))
+    def encrypt_sectors(self, sectors, data: bytes = None, sector_size: int = 4096):
+        """Encrypt many sectors at once, output is byte-identical to encrypt_sector.
+        - encrypt_sectors(start_sector, data): contiguous run, data is a multiple of sector_size, returns bytes
+        - encrypt_sectors([(sector, data), ...]): returns a list of encrypted sectors in the same order
+        """
+        if not isinstance(sectors, int):
+            return self._batch(sectors, self.encrypt_sectors)
+        if len(data) % sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {sector_size} bytes")
+        count = len(data) // sector_size
+        encrypted_data = np.frombuffer(self.aes_module.encrypt(data), dtype=np.uint8).reshape(count, sector_size)
+        forward = self._permutations(sectors, count, sector_size, reverse=False)
+        shuffled_data = np.take_along_axis(encrypted_data, forward, axis=1)
+        shuffled_data ^= self._keystreams(sectors, count, sector_size)
+        return shuffled_data.tobytes()
+
+    def decrypt_sectors(self, sectors, data: bytes = None, sector_size: int = 4096):
+        """Decrypt many sectors at once (see encrypt_sectors)"""
+        if not isinstance(sectors, int):
+            return self._batch(sectors, self.decrypt_sectors)
+        if len(data) % sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {sector_size} bytes")
+        count = len(data) // sector_size
+        unnoised_data = np.frombuffer(data, dtype=np.uint8).reshape(count, sector_size) ^ self._keystreams(sectors, count, sector_size)
+        inverse = self._permutations(sectors, count, sector_size, reverse=True)
+        unshuffled_data = memoryview(np.take_along_axis(unnoised_data, inverse, axis=1)).cast("B")
+        return self.aes_module.decrypt(unshuffled_data)
+
+    def _permutations(self, start_sector: int, count: int, sector_size: int, reverse: bool):
+        """2-D array of the permutations of a run of sectors"""
+        index = 1 if reverse else 0
+        return np.stack([
+            self._permutation(sector_number, self._generate_seed(sector_number), sector_size)[index]
+            for sector_number in range(start_sector, start_sector + count)
+        ]).astype(np.intp)
+
+    def _keystreams(self, start_sector: int, count: int, sector_size: int):
+        """2-D array of the noise of a run of sectors (one CTR call for the whole run)"""
+        if self.noise_version == NOISE_LEGACY:
+            noise = b"".join(self._legacy_keystream(self._generate_seed(sector_number), sector_size)
+                             for sector_number in range(start_sector, start_sector + count))
+        else:
+            noise = self._keystream(start_sector, count * sector_size, sector_size)
+        return np.frombuffer(noise, dtype=np.uint8).reshape(count, sector_size)
+
+    def _permutation(self, sector_number: int, seed: int, length: int):
+        """Forward and inverse index arrays of the sector shuffle (cached).
+        random.shuffle on the index list makes the same swaps as on the data, so shuffled[i] = data[forward[i]]."""
+        entry = self.permutations.get(sector_number, length)
+        if entry is not None:
+            return entry
+        indexes = list(range(length))
         random.Random(seed).shuffle(indexes)
-        unshuffled_data = bytearray(c for _, c in sorted(zip(indexes, data)))
-        return bytes(unshuffled_data)
+        dtype = np.uint16 if length <= 1 << 16 else np.uint32
+        forward = np.array(indexes, dtype=dtype)
+        inverse = np.empty_like(forward)
+        inverse[forward] = np.arange(length, dtype=dtype)
+        entry = (forward, inverse)
+        self.permutations.put(sector_number, entry)
+        return entry
+
+    def _shuffle_bytes(self, sector_number: int, seed: int, data: bytes, reverse=False) -> bytes:
+        """Shuffle or unshuffle bytes deterministically based on seed (one gather with the cached permutation)."""
+        forward, inverse = self._permutation(sector_number, seed, len(data))
+        return np.frombuffer(data, dtype=np.uint8)[inverse if reverse else forward].tobytes()
+
+
+    def _noise(self, sector_number: int, seed: int, data: bytes) -> bytes:
+        """XOR the whole buffer with the sector keystream (in one big int operation)."""
+        if self.noise_version == NOISE_LEGACY:
+            noise = self._legacy_keystream(seed, len(data))
+        else:
+            noise = self._keystream(sector_number, len(data))
+        xored = int.from_bytes(data, "big") ^ int.from_bytes(noise, "big")
+        return xored.to_bytes(len(data), "big")
+
+    def _keystream(self, sector_number: int, length: int, sector_size: int = None) -> bytes:
+        """AES-CTR keystream for a sector (or a run of sectors starting at sector_number).
+        The counter starts at sector_number*(sector_size/16) so consecutive sectors of the same size
+        are consecutive parts of one single stream."""
+        if sector_size is None:
+            sector_size = length
+        blocks = -(-length // AES.block_size)
+        ctr = AES.new(self.noise_key, AES.MODE_CTR, nonce=b"", initial_value=sector_number * (-(-sector_size // AES.block_size)))
+        return ctr.encrypt(bytes(blocks * AES.block_size))[:length]
+
+    def _legacy_keystream(self, seed: int, length: int) -> bytes:
+        """Original noise: one random.randint(0, 255) per byte (slow, kept to read old volumes)."""
+        rng = random.Random(seed)
+        return bytes([rng.randint(0, 255) for _ in range(length)])
+
+
+class XTSCrypt(SectorCipher):
+    """AES-256-XTS with the sector number as tweak, one native call per sector"""
+    cipher_id = 1
+    name = "xts"
+
+    @classmethod
+    def from_key(cls, key: bytes, pin: bytes, **options):
+        self = cls.__new__(cls)
+        self.password = key
+        self.pin = pin
+        self.xts_key = hashlib.sha512(key + pin + b"xts").digest()#2 AES-256 keys (data + tweak)
+        return self
+
+    def _cipher(self, sector_number: int) -> Cipher:
+        return Cipher(algorithms.AES(self.xts_key), modes.XTS(sector_number.to_bytes(16, "little")))
+
+    def encrypt_sector(self, sector_number: int, data: bytes) -> bytes:
+        if len(data) % 16 != 0:
+            data = pad(data, AES.block_size)
+        encryptor = self._cipher(sector_number).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt_sector(self, sector_number: int, data: bytes) -> bytes:
+        decryptor = self._cipher(sector_number).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+
+CIPHERS = {cipher.name: cipher for cipher in (SectorCrypt, XTSCrypt)}
+
+
+_worker_crypt = None#SectorCipher of a ParallelCrypt worker process
+
+
+def _init_worker(cipher_name: str, key: bytes, pin: bytes, options: dict):
+    global _worker_crypt
+    _worker_crypt = CIPHERS[cipher_name].from_key(key, pin, **options)
+
+
+def _worker_run(encrypt: bool, pairs: list) -> list:
+    if encrypt:
+        return _worker_crypt.encrypt_sectors(pairs)
+    return _worker_crypt.decrypt_sectors(pairs)
+
+
+class ParallelCrypt:
+    """Fan encrypt_sectors/decrypt_sectors out to a process pool
+    - each worker builds its cipher once from the derived key (no Argon2 per worker)
+    - pairs are sent by chunks of chunk_size sectors, results keep the input order
+    - max_in_flight: bytes submitted to the pool and not collected yet
+    - each worker gets 1/workers of the permutation cache budget of crypt
+    """
+    def __init__(self, crypt: SectorCipher, workers: int = None, chunk_size: int = 64, max_in_flight: int = 64 * 1024 ** 2):
+        self.crypt = crypt
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        options = crypt.options()
+        if "permutation_cache_bytes" in options:#the cache budget is shared by the workers
+            options["permutation_cache_bytes"] //= self.workers
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(crypt.name, crypt.password, crypt.pin, options),
+        )
+
+    def encrypt_sectors(self, pairs) -> list:
+        return list(self.imap(True, pairs))
+
+    def decrypt_sectors(self, pairs) -> list:
+        return list(self.imap(False, pairs))
 
+    def imap(self, encrypt: bool, pairs):
+        """Yield the processed sectors in order while keeping at most max_in_flight bytes in the pool"""
+        in_flight = deque()
+        in_flight_bytes = 0
+        chunk = []
+        chunk_bytes = 0
+        for pair in list(pairs) + [None]:
+            if pair is not None:
+                pair = (pair[0], bytes(pair[1]))#memoryviews can't be sent to the workers
+                chunk.append(pair)
+                chunk_bytes += len(pair[1])
+            if chunk and (pair is None or len(chunk) >= self.chunk_size):
+                while in_flight and in_flight_bytes + chunk_bytes > self.max_in_flight:
+                    future, size = in_flight.popleft()
+                    in_flight_bytes -= size
+                    yield from future.result()
+                future = self.pool.submit(_worker_run, encrypt, chunk)
+                in_flight.append((future, chunk_bytes))
+                in_flight_bytes += chunk_bytes
+                chunk = []
+                chunk_bytes = 0
+        while in_flight:
+            yield from in_flight.popleft()[0].result()
 
-    def _noise(self, seed: int, data: bytes) -> bytes:
-        """XOR each byte with a pseudorandom byte generated from the seed."""
-        random.seed(seed)
-        noise = [random.randint(0, 255) for _ in range(len(data))]
-        return bytes(data[i] ^ noise[i] for i in range(len(data)))
+    def close(self):
+        self.pool.shutdown()
 
 
 # Example usage:
@@ -97,13 +441,13 @@ if __name__ == "__main__":
     print(f"Original sector: {sector_data[:64]}...")
     crypt = SectorCrypt(password, pin)
     #shuffle test
-    shuffled_data = crypt._shuffle_bytes(sector_number, sector_data)
-    unshuffled_data = crypt._shuffle_bytes(sector_number, shuffled_data, reverse=True)
+    shuffled_data = crypt._shuffle_bytes(sector_number, sector_number, sector_data)
+    unshuffled_data = crypt._shuffle_bytes(sector_number, sector_number, shuffled_data, reverse=True)
     assert sector_data == unshuffled_data, "Shuffle failed!"
     print("Shuffle successful!")
     #noise test
-    noisy_data = crypt._noise(sector_number, sector_data)
-    unnoised_data = crypt._noise(sector_number, noisy_data)
+    noisy_data = crypt._noise(sector_number, sector_number, sector_data)
+    unnoised_data = crypt._noise(sector_number, sector_number, noisy_data)
     assert sector_data == unnoised_data, "Noise failed!"
     print("Noise successful!")
     #encryption test
@@ -1,11 +1,287 @@
 from sector import Sector
-import win32file
+try:
+    import win32file
+except ImportError:#not on windows, only ImageDisk is available
+    win32file = None
+import mmap
+import os
 import subprocess
 # import shutil
 import re
+import threading
 
-class Disk:
+IOV_MAX = getattr(os, "IOV_MAX", 1024) if hasattr(os, "pwritev") else 1
+
+def coalesce(block_numbers: list) -> list:
+    """Sorted block numbers -> list of (start, count) runs"""
+    runs = []
+    for block_number in block_numbers:
+        if runs and runs[-1][0] + runs[-1][1] == block_number:
+            runs[-1][1] += 1
+        else:
+            runs.append([block_number, 1])
+    return [tuple(run) for run in runs]
+
+
+class BlockDevice:
+    """Block device interface used by the FileSystem
+    - sector_size, number_of_sectors, disk_size (after skip), serial
+    - read_sector(sector_number, block_size): block_size octets at sector_number*block_size
+    - write_sector(sector_number, data): len(data) octets at sector_number*len(data)
+    - read_blocks/write_blocks: contiguous runs of blocks, read_many/write_many: any blocks coalesced in runs
+    """
+    serial = None
+    skip = 0
+    sector_size = 512
+    number_of_sectors = 0
+    disk_size = 0
+
+    def to_humain_readable(self,size: int):
+        """Convert bytes to humain readable format"""
+        for unit in ['o', 'Ko', 'Mo', 'Go', 'To']:
+            if size < 1024.0:
+                break
+            size /= 1024.0
+        return f"{size:.2f} {unit}"
+
+    def read_sector(self, sector_number: int, block_size: int = None)->bytes:
+        raise NotImplementedError
+
+    def write_sector(self, sector_number, data):
+        raise NotImplementedError
+
+    def read_blocks(self, start: int, count: int, block_size: int) -> bytes:
+        """Read count contiguous blocks of block_size octets starting at block start"""
+        return b"".join(self.read_sector(start + i, block_size) or b"\x00" * block_size for i in range(count))
+
+    def write_blocks(self, start: int, buffers: list):
+        """Write buffers (all of the same size) to consecutive blocks starting at block start"""
+        for i, data in enumerate(buffers):
+            self.write_sector(start + i, data)
+
+    def read_many(self, block_numbers: list, block_size: int) -> list:
+        """Read any list of blocks, contiguous blocks are read in one call, returns the blocks (memoryviews) in order"""
+        blocks = {}
+        for start, count in coalesce(sorted(set(block_numbers))):
+            data = memoryview(self.read_blocks(start, count, block_size))
+            for i in range(count):
+                blocks[start + i] = data[i*block_size:(i+1)*block_size]#memoryview, no copy
+        return [blocks[block_number] for block_number in block_numbers]
+
+    def write_many(self, pairs: list):
+        """Write any list of (block, data) pairs, contiguous blocks are written in one call"""
+        pairs = dict(pairs)#last write wins
+        for start, count in coalesce(sorted(pairs)):
+            self.write_blocks(start, [pairs[start + i] for i in range(count)])
+
+    def empty_sector_with_data(self, data: bytes):
+        """create a sector and prepad it with the data"""
+        if len(data) > self.sector_size:
+            raise ValueError(f"Data size must be less than {self.sector_size} bytes")
+        sector = data + b"\x00" * (self.sector_size - len(data))
+        return sector
+
+    def flush(self):
+        """Commit point: make previous writes durable"""
+        return
+
+    def close(self):
+        return
+
+
+class ImageDisk(BlockDevice):
+    """Linux backend: raw block device or image file
+    - one descriptor open for the life of the mount, positional os.pread/os.pwrite
+    - direct: O_DIRECT (bypass page cache), I/O go through page aligned buffers
+    - I/O errors are printed and raised (OSError)
+    - size: create/extend the image file to this size (octets)
+    """
+    def __init__(self, path: str, skip: int = 0, size: int = None, direct: bool = False, sector_size: int = 512):
+        self.path = path
+        self.serial = path
+        self.skip = skip
+        self.direct = direct
+        self.sector_size = sector_size
+        self.emptyspace = 0
+        flags = os.O_RDWR
+        if size is not None:
+            flags |= os.O_CREAT
+        if direct:
+            flags |= os.O_DIRECT
+        self.fd = os.open(path, flags, 0o600)
+        if size is not None and os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.disk_size = os.lseek(self.fd, 0, os.SEEK_END)
+        self.number_of_sectors = self.disk_size//self.sector_size
+        #skip
+        self.number_of_sectors -= self.skip
+        self.disk_size -= self.skip * self.sector_size
+        self.aligned_buffer = None
+        self.buffer_lock = threading.Lock()#the aligned buffer is shared (write pipeline thread + cache write back)
+        print(f"Image: {self.path}")
+        print(f"Disk size: {self.to_humain_readable(self.disk_size)}")
+        print(f"Sector size: {self.sector_size} octets")
+        print(f"No of sectors: {self.number_of_sectors}")
+
+    def get_aligned_buffer(self, size: int) -> mmap.mmap:
+        """Page aligned buffer for O_DIRECT (reused between calls)"""
+        if self.aligned_buffer is None or len(self.aligned_buffer) < size:
+            self.aligned_buffer = mmap.mmap(-1, max(size, mmap.PAGESIZE))
+        return self.aligned_buffer
+
+    def read_sector(self, sector_number: int, block_size: int = None)->bytes:
+        """Read a specific sector by its number"""
+        if block_size is None:
+            block_size = self.sector_size
+        if block_size % self.sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {self.sector_size} bytes")
+        offset = sector_number * block_size + self.skip * block_size
+        try:
+            if not self.direct:
+                return os.pread(self.fd, block_size, offset)
+            with self.buffer_lock:
+                buffer = self.get_aligned_buffer(block_size)
+                read = os.preadv(self.fd, [memoryview(buffer)[:block_size]], offset)
+                return buffer[:read]
+        except OSError as e:
+            print(f"Error reading sector {sector_number}: {e}")
+            raise
+
+    def write_sector(self, sector_number, data):
+        """Write data to a specific sector"""
+        block_size = len(data)
+        if block_size % self.sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {self.sector_size} bytes")
+        position = sector_number * block_size + self.skip * block_size
+        try:
+            if not self.direct:
+                self.write_all([data], position)
+                return
+            with self.buffer_lock:
+                buffer = self.get_aligned_buffer(block_size)
+                buffer[:block_size] = data
+                self.write_all([memoryview(buffer)[:block_size]], position)
+        except OSError as e:
+            print(f"Error writing to sector {sector_number}: {e}")
+            raise
+
+    def read_blocks(self, start: int, count: int, block_size: int) -> bytes:
+        """One preadv into a preallocated buffer (returned as is, no copy)"""
+        offset = start * block_size + self.skip * block_size
+        size = count * block_size
+        try:
+            if self.direct:
+                with self.buffer_lock:
+                    buffer = self.get_aligned_buffer(size)
+                    read = os.preadv(self.fd, [memoryview(buffer)[:size]], offset)
+                    return buffer[:read].ljust(size, b"\x00")
+            buffer = bytearray(size)
+            os.preadv(self.fd, [buffer], offset)
+            return buffer
+        except OSError as e:#not returned as 0s: they would be read as never written blocks
+            print(f"Error reading sectors {start} to {start+count-1}: {e}")
+            raise
+
+    def write_blocks(self, start: int, buffers: list):
+        """Gather write with pwritev (IOV_MAX buffers per call)"""
+        if not buffers:
+            return
+        block_size = len(buffers[0])
+        if block_size % self.sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {self.sector_size} bytes")
+        offset = start * block_size + self.skip * block_size
+        try:
+            if self.direct:
+                size = block_size * len(buffers)
+                with self.buffer_lock:
+                    buffer = self.get_aligned_buffer(size)
+                    buffer[:size] = b"".join(buffers)
+                    self.write_all([memoryview(buffer)[:size]], offset)
+                return
+            for i in range(0, len(buffers), IOV_MAX):
+                self.write_all(buffers[i:i+IOV_MAX], offset + i * block_size)
+        except OSError as e:#raised: the write pipeline is cancelled and the blocks of the file are freed
+            print(f"Error writing to sectors {start} to {start+len(buffers)-1}: {e}")
+            raise
+
+    def write_all(self, buffers: list, offset: int):
+        """pwritev (pwrite without it) until every octet is written: a short write goes on with the rest"""
+        views = [memoryview(buffer).cast("B") for buffer in buffers]
+        while views:
+            written = os.pwritev(self.fd, views, offset) if IOV_MAX > 1 else os.pwrite(self.fd, views[0], offset)
+            if written <= 0:
+                raise OSError(f"Short write at offset {offset}")
+            offset += written
+            while views and written >= len(views[0]):
+                written -= len(views.pop(0))
+            if written:
+                views[0] = views[0][written:]
+
+    def flush(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MmapDisk(ImageDisk):
+    """Image file mapped in memory
+    - read_sector/read_blocks return memoryview slices of the mapping (no copy)
+    - writes go straight into the mapping, flush() (msync) at commit points
+    """
+    def __init__(self, path: str, skip: int = 0, size: int = None, sector_size: int = 512):
+        super().__init__(path, skip, size, False, sector_size)
+        self.map = mmap.mmap(self.fd, 0)
+        self.view = memoryview(self.map)
+
+    def read_sector(self, sector_number: int, block_size: int = None) -> memoryview:
+        """Read a specific sector by its number"""
+        if block_size is None:
+            block_size = self.sector_size
+        if block_size % self.sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {self.sector_size} bytes")
+        offset = sector_number * block_size + self.skip * block_size
+        return self.view[offset:offset + block_size]
+
+    def write_sector(self, sector_number, data):
+        """Write data to a specific sector"""
+        block_size = len(data)
+        if block_size % self.sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {self.sector_size} bytes")
+        position = sector_number * block_size + self.skip * block_size
+        self.view[position:position + block_size] = data
+
+    def read_blocks(self, start: int, count: int, block_size: int) -> memoryview:
+        offset = start * block_size + self.skip * block_size
+        return self.view[offset:offset + count * block_size]
+
+    def write_blocks(self, start: int, buffers: list):
+        for i, data in enumerate(buffers):
+            self.write_sector(start + i, data)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:#a block read is still referenced, the mapping is closed when it is released
+            pass
+        self.map = None
+        super().close()
+
+
+class Disk(BlockDevice):
+    """Windows backend: physical drive found by its serial (win32file + wmic)"""
     def __init__(self, serial: str, skip: int = 0):
+        if win32file is None:
+            raise OSError("win32file is not available, mount an image file instead (image=path)")
         self.skip = skip
         self.emptyspace = 0
         self.serial = serial
@@ -31,14 +307,6 @@ class Disk:
         print(f"No of sectors: {int(self.disk_size / self.sector_size)}")
         print(f"Physical drive: {self.physical_drive}")
 
-    def to_humain_readable(self,size: int):
-        """Convert bytes to humain readable format"""
-        for unit in ['o', 'Ko', 'Mo', 'Go', 'To']:
-            if size < 1024.0:
-                break
-            size /= 1024.0
-        return f"{size:.2f} {unit}"
-
     def list_disks(self):
         cmdoutput = subprocess.check_output("wmic diskdrive get SerialNumber, DeviceID, Size, TotalSectors", shell=True)
         cmdoutput = cmdoutput.decode(errors="ignore")
@@ -106,6 +374,33 @@ class Disk:
             print(f"Error reading sector {sector_number}: {e}")
             return None
 
+    def read_blocks(self, start: int, count: int, block_size: int) -> bytes:
+        """One ReadFile for the whole run"""
+        try:
+            if self.read_disk_handle is None:
+                self.read_disk_handle = self.get_handle()
+            win32file.SetFilePointer(self.read_disk_handle, start * block_size + self.skip * block_size, win32file.FILE_BEGIN)
+            result, data = win32file.ReadFile(self.read_disk_handle, count * block_size)
+            return data
+        except Exception as e:
+            print(f"Error reading sectors {start} to {start+count-1}: {e}")
+            return bytes(count * block_size)
+
+    def write_blocks(self, start: int, buffers: list):
+        """One WriteFile for the whole run"""
+        if not buffers:
+            return
+        block_size = len(buffers[0])
+        if block_size % self.sector_size != 0:
+            raise ValueError(f"Data size must be a multiple of {self.sector_size} bytes")
+        write_disk_handle = self.get_handle()
+        try:
+            win32file.SetFilePointer(write_disk_handle, start * block_size + self.skip * block_size, win32file.FILE_BEGIN)
+            win32file.WriteFile(write_disk_handle, b"".join(buffers))
+        except Exception as e:
+            print(f"Error writing to sectors {start} to {start+len(buffers)-1}: {e}")
+        win32file.CloseHandle(write_disk_handle)
+
     def write_sector(self, sector_number, data):
         """Write data to a specific sector"""
         block_size = len(data)
@@ -168,13 +463,6 @@ class Disk:
                 self.read_disk_handle = None
                 return sector.number
 
-    def empty_sector_with_data(self, data: bytes):
-        """create a sector and prepad it with the data"""
-        if len(data) > self.sector_size:
-            raise ValueError(f"Data size must be less than {self.sector_size} bytes")
-        sector = data + b"\x00" * (self.sector_size - len(data))
-        return sector
-    
     def reset_disk(self):
         """reset the FULL disk"""
         print("Resetting disk")
@@ -0,0 +1,106 @@
+import hashlib
+import os
+from Crypto.Cipher import AES
+from argon2.low_level import hash_secret_raw, Type
+
+
+class KeySlots:
+    """LUKS style key slots header, stored in clear in the last block of the volume
+    - the data key is a random master key
+    - each slot holds the master key encrypted (AES-GCM) with a key derived from a password/PIN (Argon2id)
+    - changing a password rewrites this block only
+
+    layout:
+        - magic number (4 octets)
+        - version (1 octet)
+        - volume id (16 octets, used by the unlock agent)
+        - 8 slots of 83 octets:
+            - active (1 octet)
+            - salt (16 octets)
+            - time_cost (1 octet), memory_cost in Kio (4 octets), parallelism (1 octet)
+            - nonce (12 octets), wrapped master key (32 octets), tag (16 octets)
+    """
+    magic_number = b"SFSK"
+    version = 1
+    number_of_slots = 8
+    slot_size = 83
+    header_size = 21
+
+    def __init__(self, data: bytes = None):
+        self.volume_id = os.urandom(16)
+        self.slots = [None] * self.number_of_slots
+        if data is None:
+            return
+        if not self.is_header(data):
+            raise ValueError("Not a key slots header")
+        self.volume_id = data[5:21]
+        for i in range(self.number_of_slots):
+            slot = data[self.header_size + i*self.slot_size:self.header_size + (i+1)*self.slot_size]
+            if slot[0] == 1:
+                self.slots[i] = slot[1:]
+
+    @classmethod
+    def is_header(cls, data: bytes) -> bool:
+        return data is not None and data[:4] == cls.magic_number
+
+    @classmethod
+    def create(cls, password: str, pin: str):
+        """New header with a random master key in slot 0, returns (header, master key)"""
+        keyslots = cls()
+        master_key = os.urandom(32)
+        keyslots.add(master_key, password, pin)
+        return keyslots, master_key
+
+    @staticmethod
+    def volume_pin(master_key: bytes) -> bytes:
+        """16 octets used as PIN by the sector ciphers (the user PIN can change, this one can't)"""
+        return hashlib.shake_256(master_key + b"pin").digest(16)
+
+    @staticmethod
+    def _derive(password: str, pin: str, salt: bytes, time_cost: int, memory_cost: int, parallelism: int) -> bytes:
+        secret = password.encode("utf-8") + hashlib.shake_256(pin.encode("utf-8")).digest(16)
+        return hash_secret_raw(secret, salt, time_cost=time_cost, memory_cost=memory_cost,
+                               parallelism=parallelism, hash_len=32, type=Type.ID)
+
+    def add(self, master_key: bytes, password: str, pin: str, time_cost: int = 2, memory_cost: int = 1024 ** 2, parallelism: int = 2) -> int:
+        """Store the master key in the first free slot, returns the slot number"""
+        if None not in self.slots:
+            raise Exception("All key slots are used")
+        index = self.slots.index(None)
+        salt = os.urandom(16)
+        kek = self._derive(password, pin, salt, time_cost, memory_cost, parallelism)
+        nonce = os.urandom(12)
+        wrapped_key, tag = AES.new(kek, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(master_key)
+        self.slots[index] = (salt + time_cost.to_bytes(1, "big") + memory_cost.to_bytes(4, "big")
+                             + parallelism.to_bytes(1, "big") + nonce + wrapped_key + tag)
+        return index
+
+    def remove(self, index: int):
+        if self.slots[index] is None:
+            raise ValueError(f"Key slot {index} is not used")
+        if self.slots.count(None) == self.number_of_slots - 1:
+            raise ValueError("Cannot remove the last key slot")
+        self.slots[index] = None
+
+    def unlock(self, password: str, pin: str):
+        """Try every active slot, returns (master key, slot number)"""
+        for index, slot in enumerate(self.slots):
+            if slot is None:
+                continue
+            salt = slot[:16]
+            time_cost = slot[16]
+            memory_cost = int.from_bytes(slot[17:21], "big")
+            parallelism = slot[21]
+            nonce, wrapped_key, tag = slot[22:34], slot[34:66], slot[66:82]
+            kek = self._derive(password, pin, salt, time_cost, memory_cost, parallelism)
+            try:
+                return AES.new(kek, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(wrapped_key, tag), index
+            except ValueError:
+                continue
+        raise ValueError("Wrong password or PIN")
+
+    def to_bytes(self) -> bytes:
+        data = self.magic_number + self.version.to_bytes(1, "big") + self.volume_id
+        for slot in self.slots:
+            data += b"\x01" + slot if slot is not None else b"\x00" * self.slot_size
+        return data
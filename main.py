@@ -18,6 +18,7 @@ class FSExplorerGUI(QMainWindow):
         super().__init__()
         self.setWindowTitle("Super FileSystem Explorer")
         self.fs = None
+        self.current_path = ""#directory shown in the file list ("": root)
         self.LoginUI()
 
     def LoginUI(self):#login
@@ -53,11 +54,24 @@ class FSExplorerGUI(QMainWindow):
         self.file_list.setSelectionMode(QAbstractItemView.MultiSelection)
         self.file_list.setContextMenuPolicy(Qt.CustomContextMenu)
         self.file_list.customContextMenuRequested.connect(self.on_right_click)
+        self.file_list.itemDoubleClicked.connect(self.open_directory)
 
         self.create_file_btn = QPushButton("Create file")
         self.create_file_btn.clicked.connect(self.create_file_wizard)
         self.layout.addWidget(self.create_file_btn)
 
+        self.import_files_btn = QPushButton("Import files")
+        self.import_files_btn.clicked.connect(self.import_files)
+        self.layout.addWidget(self.import_files_btn)
+
+        self.import_dir_btn = QPushButton("Import folder")
+        self.import_dir_btn.clicked.connect(self.import_directory)
+        self.layout.addWidget(self.import_dir_btn)
+
+        self.create_dir_btn = QPushButton("New folder")
+        self.create_dir_btn.clicked.connect(self.create_directory)
+        self.layout.addWidget(self.create_dir_btn)
+
         self.delete_file_btn = QPushButton("Delete file")
         self.delete_file_btn.clicked.connect(self.delete_file)
         self.layout.addWidget(self.delete_file_btn)
@@ -81,11 +95,35 @@ class FSExplorerGUI(QMainWindow):
         if not self.fs:
             print("Filesystem not initialized!")
             return
+        entries = self.fs.list_directory(self.current_path)
+        if entries is None:
+            self.current_path = ""
+            entries = self.fs.list_directory()
+        self.setWindowTitle(f"Super FileSystem Explorer - /{self.current_path}")
         self.file_list.clear()
-        for fname in self.fs.directory:
-            item = QListWidgetItem(f"{fname} {to_humain_readable(self.fs.directory[fname].size)}")
+        if self.current_path:
+            self.file_list.addItem("..")
+        for fname, inode in entries.items():
+            if inode.is_directory():
+                item = QListWidgetItem(f"{fname}/")
+            else:
+                item = QListWidgetItem(f"{fname} {to_humain_readable(inode.size)}")
             self.file_list.addItem(item)
 
+    def item_path(self, item)->str:
+        """Path in the filesystem of a list item ("name size" or "name/")"""
+        name = item.text().split(" ")[0].rstrip("/")
+        return f"{self.current_path}/{name}" if self.current_path else name
+
+    def open_directory(self, item):
+        if item.text() == "..":
+            self.current_path = "/".join(self.current_path.split("/")[:-1])
+        elif item.text().endswith("/"):
+            self.current_path = self.item_path(item)
+        else:
+            return
+        self.list_files()
+
     def on_right_click(self,pos):
         item = self.file_list.itemAt(pos)
         if item:
@@ -110,11 +148,11 @@ class FSExplorerGUI(QMainWindow):
             print("No output directory selected!")
             return
         for item in selected_items:
+            if item.text() == ".." or item.text().endswith("/"):
+                continue
             file_name = item.text().split(" ")[0]
             with open(os.path.join(output_dir, file_name), "wb") as f:
-                for chunk in self.fs.read_file(file_name):
-                    #remove trailing \x00
-                    chunk = chunk.rstrip(b"\x00")
+                for chunk in self.fs.read_file(self.item_path(item)):#exactly the file size, no padding
                     f.write(chunk)
                 f.close()
             print(f"File {file_name} downloaded!")
@@ -128,13 +166,16 @@ class FSExplorerGUI(QMainWindow):
             print("No file selected!")
             return
         for item in selected_items:
+            if item.text() == "..":
+                continue
             print(item.text())
-            file_name = item.text().split(" ")[0]
-            file_size = " ".join(item.text().split(" ")[1:])
-            new_name, ok = QInputDialog.getText(self, "File rename", "Enter new file name:")
-            if ok and new_name:
+            file_name = self.item_path(item)
+            new_name, ok = QInputDialog.getText(self, "File rename", "Enter new file name (or path):")
+            if ok and new_name and " " not in new_name:
+                if "/" not in new_name and self.current_path:
+                    new_name = f"{self.current_path}/{new_name}"
                 self.fs.rename_file(file_name, new_name)
-                item.setText(f"{new_name} {file_size}")
+        self.list_files()
 
     def create_file_wizard(self):
         if not self.fs:
@@ -144,12 +185,58 @@ class FSExplorerGUI(QMainWindow):
         if ok and file_name and " " not in file_name:
             file_path, _ = QFileDialog.getOpenFileName(self, "Select a source file")
             if file_path:
+                if self.current_path:
+                    file_name = f"{self.current_path}/{file_name}"
                 self.fs.create_file(file_name, file_path)
-                fsize = os.path.getsize(file_path)
-                self.file_list.addItem(f"{file_name} {to_humain_readable(fsize)}")
+                self.list_files()
         elif " " in file_name:
             print("File name cannot contain spaces!")
 
+    def import_files(self):
+        if not self.fs:
+            print("Filesystem not initialized!")
+            return
+        file_paths, _ = QFileDialog.getOpenFileNames(self, "Select files to import")
+        if file_paths:
+            self.run_import(file_paths)
+
+    def import_directory(self):
+        if not self.fs:
+            print("Filesystem not initialized!")
+            return
+        directory = QFileDialog.getExistingDirectory(self, "Select a directory to import")
+        if directory:
+            self.run_import(directory)
+
+    def run_import(self, source):
+        """create_files in the current directory with a progress dialog"""
+        dialog = QProgressDialog("Importing files...", None, 0, 100, self)
+        dialog.setWindowModality(Qt.WindowModal)
+        def progress(done, total, written):
+            dialog.setMaximum(total)
+            dialog.setValue(done)
+            dialog.setLabelText(f"Importing files {done}/{total} ({to_humain_readable(written)})")
+            QApplication.processEvents()
+        stats = self.fs.create_files(source, self.current_path, progress=progress)
+        dialog.close()
+        QMessageBox.information(self, "Import", f"{stats['files']} files imported ({to_humain_readable(stats['bytes'])}) in {stats['seconds']:.1f}s, "
+                                f"{to_humain_readable(stats['throughput'])}/s, {len(stats['failed'])} failed")
+        self.list_files()
+
+    def create_directory(self):
+        if not self.fs:
+            print("Filesystem not initialized!")
+            return
+        dir_name, ok = QInputDialog.getText(self, "New folder", "Enter folder name:")
+        if ok and dir_name and " " not in dir_name:
+            if self.current_path:
+                dir_name = f"{self.current_path}/{dir_name}"
+            if not self.fs.mkdir(dir_name):
+                print(f"Cannot create {dir_name}!")
+            self.list_files()
+        elif " " in dir_name:
+            print("Folder name cannot contain spaces!")
+
     def delete_file(self):
         if not self.fs:
             print("Filesystem not initialized!")
@@ -159,10 +246,12 @@ class FSExplorerGUI(QMainWindow):
             print("No file selected!")
             return
         for item in selected_items:
-            file_name = item.text().split(" ")[0]
+            if item.text() == "..":
+                continue
+            file_name = self.item_path(item)
             if self.fs.delete_file(file_name):
                 print(f"File {file_name} deleted!")
-            self.file_list.takeItem(self.file_list.row(item))
+        self.list_files()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
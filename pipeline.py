@@ -0,0 +1,101 @@
+import queue
+import threading
+
+
+class PipelineCancelled(Exception):
+    """A stage of the pipeline failed or it was cancelled"""
+
+
+class WritePipeline:
+    """Write path in 3 stages joined by bounded queues:
+    - source reader: the caller, submit() a batch of (block, data) pairs
+    - encryptor thread: encrypt(pairs) -> pairs
+    - device writer thread: write(pairs)
+    depth: batches waiting between 2 stages (2: double buffering), so memory stays bounded
+    An error in a stage cancels the pipeline and is raised in the caller (submit/close),
+    leaving the with block with an exception cancels it too.
+    """
+    def __init__(self, encrypt, write, depth: int = 2):
+        self.encrypt = encrypt
+        self.write = write
+        self.to_encrypt = queue.Queue(maxsize=depth)
+        self.to_write = queue.Queue(maxsize=depth)
+        self.cancelled = threading.Event()
+        self.error = None
+        self.threads = [
+            threading.Thread(target=self.stage, args=(self.to_encrypt, self.encrypt, self.to_write), daemon=True),
+            threading.Thread(target=self.stage, args=(self.to_write, self.write, None), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stage(self, source: queue.Queue, function, destination: queue.Queue):
+        while True:
+            pairs = self.get(source)
+            if pairs is None:#end of stream (or cancelled)
+                break
+            try:
+                result = function(pairs)
+            except BaseException as e:
+                self.fail(e)
+                break
+            if destination is not None and not self.put(destination, result):
+                break
+        if destination is not None:
+            self.put(destination, None)
+
+    def get(self, source: queue.Queue):
+        while not self.cancelled.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def put(self, destination: queue.Queue, item) -> bool:
+        while not self.cancelled.is_set():
+            try:
+                destination.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fail(self, error: BaseException):
+        if self.error is None:
+            self.error = error
+        self.cancelled.set()
+
+    def check(self):
+        if self.error is not None:
+            raise PipelineCancelled(f"Write pipeline failed: {self.error}") from self.error
+        if self.cancelled.is_set():
+            raise PipelineCancelled("Write pipeline cancelled")
+
+    def submit(self, pairs: list):
+        """Send a batch to the encryptor (blocks while the queue is full)"""
+        self.check()
+        if not self.put(self.to_encrypt, list(pairs)):
+            self.check()
+
+    def close(self):
+        """Wait until every batch is written"""
+        self.put(self.to_encrypt, None)
+        for thread in self.threads:
+            thread.join()
+        self.check()
+
+    def cancel(self):
+        self.cancelled.set()
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cancel()
+        return False
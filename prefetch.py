@@ -0,0 +1,66 @@
+import queue
+import threading
+
+
+class ReadAhead:
+    """Sequential read-ahead: a background thread resolves the next block numbers,
+    reads and decrypts them by batches while the consumer handles the previous ones
+    - pointers: iterator of block numbers (pointer blocks are read by the thread, ahead of the consumer)
+    - read_batch: function reading (and decrypting) a list of blocks
+    - the window starts at min_window blocks and doubles after each batch while the read stays sequential, up to max_window
+    - memory: at most depth batches of max_window blocks wait for the consumer
+    """
+    def __init__(self, pointers, read_batch, max_window: int = 256, min_window: int = 8, depth: int = 2):
+        self.pointers = iter(pointers)
+        self.read_batch = read_batch
+        self.max_window = max(max_window, 1)
+        self.window = min(min_window, self.max_window)
+        self.batches = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            last = None
+            while not self.stop.is_set():
+                batch = []
+                for pointer in self.pointers:
+                    batch.append(pointer)
+                    if len(batch) >= self.window:
+                        break
+                if not batch:
+                    break
+                self.put(("data", self.read_batch(batch)))
+                sequential = last is None or batch[0] == last + 1
+                last = batch[-1]
+                #contiguous blocks: read more at once next time, else start again small
+                self.window = min(self.window * 2, self.max_window) if sequential else max(self.window // 2, 1)
+            self.put(("end", None))
+        except Exception as e:
+            self.put(("error", e))
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        try:
+            while True:
+                kind, value = self.batches.get()
+                if kind == "end":
+                    return
+                if kind == "error":
+                    raise value
+                yield from value
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the thread (consumer done or cancelled)"""
+        self.stop.set()
+        self.thread.join()
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import custom_crypt
+import keyslot
+import FS
+
+PASSWORD = "password"
+PIN = "1234"
+BLOCKS = 65536#256Mo image (sparse): enough blocks for inode blocks, bitmap summary and journal
+
+
+@pytest.fixture(autouse=True)
+def fast_kdf(monkeypatch):
+    """Cheap key derivation: argon2 with its real parameters takes seconds and 1Go per mount
+    - derived key of volumes without key slots: sha256(password + hashed pin) (tests/data/legacy_volume.bin uses it too)
+    - key slots: lowest argon2 cost
+    """
+    monkeypatch.setattr(custom_crypt.SectorCrypt, "_derive_password",
+                        lambda self: hashlib.sha256(self.raw_password.encode()+self.pin).digest())
+    add = keyslot.KeySlots.add
+    monkeypatch.setattr(keyslot.KeySlots, "add",
+                        lambda self, master_key, password, pin, time_cost=1, memory_cost=1024, parallelism=1:
+                        add(self, master_key, password, pin, time_cost, memory_cost, parallelism))
+
+
+@pytest.fixture
+def image(tmp_path):
+    """Path of an empty image file (sparse), mounted with image= as in the README"""
+    path = tmp_path/"volume.img"
+    with open(path, "wb") as f:
+        f.truncate(BLOCKS*4096)
+    return str(path)
+
+
+def mount(image:str, **options)->FS.FileSystem:
+    """Mount (or create) the volume of an image file"""
+    options.setdefault("use_agent", False)
+    return FS.FileSystem(0, PASSWORD, PIN, image=image, **options)
+
+
+def crash(fs:FS.FileSystem):
+    """Power loss after the last commit: the cache is not written back, no checkpoint, no directory index"""
+    fs.stop_workers()
+    fs.disk.close()
+
+
+def used_blocks(fs:FS.FileSystem)->int:
+    """Data blocks marked used in the bitmap"""
+    for number in range(1, fs.number_of_bitmap_blocks+1):
+        fs.load_bitmap(number)
+    return int(fs.bitmap_capacity.sum()-fs.free_counts.sum())
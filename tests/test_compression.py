@@ -0,0 +1,110 @@
+import io
+import random
+import pytest
+import FS
+from conftest import mount, crash, used_blocks
+
+
+@pytest.fixture(scope="module")
+def logs()->bytes:
+    rnd = random.Random(7)
+    return b"".join(f"2026-10-18 12:{i%60:02d}:{i%59:02d} INFO worker-{i%8} request {i} served in {rnd.randrange(1, 999)} ms\n".encode()
+                    for i in range(60000))
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_compressed_round_trip(image, logs, codec):
+    fs = mount(image, compression=codec)
+    empty = used_blocks(fs)
+    assert fs.create_file("log", logs)
+    inode = fs.find_file("log")
+    assert inode.flags & FS.INODE_COMPRESSED and inode.size == len(logs)
+    assert (used_blocks(fs)-empty)*3 < -(-len(logs)//fs.block_size)
+    fs.close()
+    fs = mount(image)#compression is a property of the file, not of the mount
+    assert b"".join(fs.read_file("log")) == logs
+    rnd = random.Random(1)
+    for _ in range(20):
+        offset = rnd.randrange(0, len(logs))
+        length = rnd.randrange(0, 200000)
+        assert fs.read_range("log", offset, length) == logs[offset:offset+length]
+    with fs.open("log") as f:
+        f.seek(123457)
+        assert f.read(1000) == logs[123457:124457]
+    assert fs.delete_file("log")
+    fs.close()
+    fs = mount(image)
+    assert used_blocks(fs) == empty
+    fs.close()
+
+
+def test_incompressible_frames_stored_raw(image):
+    data = random.Random(2).randbytes(300000)
+    fs = mount(image)
+    empty = used_blocks(fs)
+    assert fs.create_file("rnd", data, compression="zlib")
+    assert used_blocks(fs)-empty <= -(-len(data)//fs.block_size)+2#frame table (and pointer block) only
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("rnd")) == data
+    fs.close()
+
+
+def test_compressed_write_at_and_truncate(image, logs):
+    fs = mount(image)
+    with fs.open("lz", "wb", compression="lzma") as f:
+        f.write(logs[:100000])
+    with fs.open("lz", "ab") as f:
+        f.write(logs[100000:250000])
+    model = bytearray(logs[:250000])
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("lz")) == bytes(model)
+    assert fs.write_at("lz", 70000, b"X"*5000)
+    model[70000:75000] = b"X"*5000
+    assert fs.write_at("lz", 260000, b"tail")
+    model += bytes(10000)+b"tail"
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("lz")) == bytes(model)
+    assert fs.find_file("lz").flags & FS.INODE_COMPRESSED
+    assert fs.truncate("lz", 100001)
+    del model[100001:]
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("lz")) == bytes(model)
+    assert fs.read_range("lz", 69990, 100) == bytes(model[69990:70090])
+    assert fs.truncate("lz", 100)
+    assert fs.find_file("lz").is_small()
+    assert fs.truncate("lz", 0)
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("lz")) == b""
+    fs.close()
+
+
+def test_append_keeps_the_file_format(image, logs):
+    fs = mount(image, compression="zlib")
+    assert fs.create_file("raw", io.BytesIO(logs[:30000]), compression="none")
+    with fs.open("raw", "ab") as f:
+        f.write(logs[30000:42000])
+    assert not fs.find_file("raw").flags & FS.INODE_COMPRESSED
+    assert fs.create_file("z", logs[:30000])
+    with fs.open("z", "ab") as f:
+        f.write(logs[30000:42000])
+    assert fs.find_file("z").flags & FS.INODE_COMPRESSED
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("raw")) == logs[:42000]
+    assert b"".join(fs.read_file("z")) == logs[:42000]
+    fs.close()
+
+
+def test_compressed_files_replayed_after_crash(image, logs):
+    fs = mount(image, compression="zlib", checkpoint_interval=1e9)
+    assert fs.create_file("log", logs[:200000])
+    crash(fs)
+    fs = mount(image)
+    assert fs.find_file("log").flags & FS.INODE_COMPRESSED
+    assert b"".join(fs.read_file("log")) == logs[:200000]
+    fs.close()
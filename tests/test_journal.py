@@ -0,0 +1,50 @@
+from conftest import mount, crash
+
+
+def test_replay_after_crash(image):
+    fs = mount(image, checkpoint_interval=1e9)
+    for i in range(10):
+        assert fs.create_file(f"f{i}", bytes([i])*5000)
+    assert fs.delete_file("f3")
+    assert fs.checkpoint_pending#committed in the journal only
+    crash(fs)
+    fs = mount(image)
+    assert set(fs.directory) == {f"f{i}" for i in range(10) if i != 3}
+    assert b"".join(fs.read_file("f7")) == b"\x07"*5000
+    assert fs.journal_head == 1 and not fs.checkpoint_pending
+    fs.close()
+
+
+def test_torn_transaction_is_not_replayed(image):
+    fs = mount(image, checkpoint_interval=1e9)
+    assert fs.create_file("kept", b"k"*5000)
+    assert fs.delete_file("kept")
+    fs.disk.write_sector(fs.offset_journal+fs.journal_head-1, b"\x00"*fs.block_size)#commit block of the delete lost
+    crash(fs)
+    fs = mount(image)
+    assert b"".join(fs.read_file("kept")) == b"k"*5000
+    fs.close()
+
+
+def test_journal_wraps_with_checkpoints(image):
+    fs = mount(image, checkpoint_interval=1e9)
+    for i in range(3*fs.journal_blocks//4):#more transactions than the journal holds
+        assert fs.create_file(f"g{i}", b"g"*5000)
+    count = len(fs.directory)
+    crash(fs)
+    fs = mount(image)
+    assert len(fs.directory) == count
+    assert b"".join(fs.read_file("g0")) == b"g"*5000
+    fs.close()
+
+
+def test_transaction_bigger_than_the_journal(image, capsys):
+    fs = mount(image, checkpoint_interval=1e9)
+    first = fs.number_of_blocks-2*fs.journal_blocks-1#free data blocks at the end of the volume
+    pairs = [(first+i, bytes([i % 251])*fs.block_size) for i in range(fs.journal_blocks+10)]
+    fs.commit_transaction(pairs)
+    assert "not atomic" in capsys.readouterr().out
+    crash(fs)
+    fs = mount(image)
+    assert [bytes(block) for block in fs.read_sectors([block for block, _ in pairs])] == [data for _, data in pairs]
+    fs.close()
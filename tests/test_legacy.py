@@ -0,0 +1,39 @@
+import os
+from conftest import mount, used_blocks
+
+LEGACY = os.path.join(os.path.dirname(__file__), "data", "legacy_volume.bin")
+DATA = bytes(range(256))*40+b"legacy"#content of "old"
+
+
+def legacy_image(image:str)->str:
+    """Volume created by the first version of FS.py (no key slots, random based noise, legacy bitmap, no journal):
+    legacy_volume.bin holds its first blocks (superblock, bitmap, inode block, data of "old"), the rest is empty"""
+    with open(LEGACY, "rb") as source, open(image, "r+b") as f:
+        f.write(source.read())
+    return image
+
+
+def test_read_legacy_volume(image):
+    fs = mount(legacy_image(image))
+    assert fs.keyslots is None and fs.journal_blocks == 0
+    assert list(fs.directory) == ["old"]
+    assert b"".join(fs.read_file("old")) == DATA
+    assert fs.read_range("old", 1000, 300) == DATA[1000:1300]
+    fs.close()
+
+
+def test_write_legacy_volume(image):
+    fs = mount(legacy_image(image))
+    used = used_blocks(fs)
+    assert fs.create_file("new", b"n"*9000)
+    assert used_blocks(fs) == used+3
+    fs.close()
+    fs = mount(image)
+    assert sorted(fs.directory) == ["new", "old"]
+    assert b"".join(fs.read_file("old")) == DATA
+    assert b"".join(fs.read_file("new")) == b"n"*9000
+    assert fs.delete_file("old")
+    fs.close()
+    fs = mount(image)
+    assert list(fs.directory) == ["new"]
+    fs.close()
@@ -0,0 +1,111 @@
+import random
+import pytest
+import FS
+from conftest import mount, crash, used_blocks
+
+
+@pytest.mark.parametrize("directory_index", [False, True])
+def test_tail_blocks_shared_across_mounts(image, directory_index):
+    fs = mount(image, directory_index=directory_index)
+    empty = used_blocks(fs)
+    fs.close()
+    for i in range(10):#one small file per mount
+        fs = mount(image, directory_index=directory_index)
+        with fs.open(f"f{i}", "wb") as f:
+            f.write(bytes([i])*100)
+        fs.close()
+    fs = mount(image, directory_index=directory_index)
+    assert used_blocks(fs)-fs.index_blocks-empty == 1
+    assert fs.delete_file("f3")
+    fs.close()
+    fs = mount(image, directory_index=directory_index)
+    assert fs.create_file("g", b"g"*120)#reuses the units of f3
+    assert fs.find_file("g").direct[0] == fs.find_file("f0").direct[0]
+    fs.close()
+    fs = mount(image, directory_index=directory_index)
+    for i in range(10):
+        if i != 3:
+            assert b"".join(fs.read_file(f"f{i}")) == bytes([i])*100
+    assert b"".join(fs.read_file("g")) == b"g"*120
+    assert used_blocks(fs)-fs.index_blocks-empty == 1
+    fs.close()
+
+
+def test_inline_and_tail_round_trip(image):
+    rnd = random.Random(3)
+    files = {f"f{i}": rnd.randbytes(rnd.choice([1, 20, 24, 25, 100, 700, 2048, 2049, 5000])) for i in range(50)}#64 inode slots on the test volume
+    fs = mount(image)
+    empty = used_blocks(fs)
+    assert fs.mkdir("d")
+    for name, data in files.items():
+        assert fs.create_file("d/"+name, data)
+    fs.close()
+    fs = mount(image)
+    for name, data in files.items():
+        inode = fs.find_file("d/"+name)
+        assert b"".join(fs.read_file("d/"+name)) == data
+        assert fs.read_range("d/"+name, 3, 50) == data[3:53]
+        if len(data) <= FS.INLINE_SIZE:
+            assert inode.flags & FS.INODE_INLINE
+        elif len(data) <= fs.block_size//2:
+            assert inode.flags & FS.INODE_TAIL
+        else:
+            assert not inode.is_small()
+    assert used_blocks(fs)-empty < sum(-(-len(data)//fs.block_size) for data in files.values())//2
+    for name in files:
+        assert fs.delete_file("d/"+name)
+    assert fs.delete_file("d")
+    fs.close()
+    fs = mount(image)
+    assert used_blocks(fs) == empty#every tail block is freed with its last file
+    fs.close()
+
+
+def test_small_file_edits(image):
+    rnd = random.Random(4)
+    fs = mount(image)
+    assert fs.create_file("r", b"hello") and fs.find_file("r").flags & FS.INODE_INLINE
+    with fs.open("r", "ab") as f:
+        f.write(b" world"*10)
+    assert fs.find_file("r").flags & FS.INODE_TAIL
+    model = bytearray(b"hello"+b" world"*10)
+    for step in range(100):
+        if rnd.random() < 0.5:
+            offset, data = rnd.randrange(0, len(model)+100), rnd.randbytes(rnd.randrange(1, 3000 if step % 10 == 0 else 100))
+            assert fs.write_at("r", offset, data)
+            model += bytes(max(0, offset-len(model)))
+            model[offset:offset+len(data)] = data
+        else:
+            size = rnd.randrange(0, len(model)+50)
+            assert fs.truncate("r", size)
+            del model[size:]
+            model += bytes(size-len(model))
+        if step % 25 == 24:
+            fs.close()
+            fs = mount(image)
+        assert b"".join(fs.read_file("r")) == bytes(model)
+    fs.close()
+
+
+def test_small_files_replayed_after_crash(image):
+    fs = mount(image, checkpoint_interval=1e9)
+    for i in range(10):
+        with fs.open(f"t{i}", "wb") as f:
+            f.write(bytes([65+i])*300)
+    crash(fs)
+    fs = mount(image)
+    for i in range(10):
+        assert b"".join(fs.read_file(f"t{i}")) == bytes([65+i])*300
+    with fs.open("t10", "wb") as f:
+        f.write(b"z"*300)
+    assert fs.find_file("t10").direct[0] == fs.find_file("t0").direct[0]#tail table rebuilt from the replayed inodes
+    fs.close()
+
+
+def test_small_files_disabled(image):
+    fs = mount(image, small_files=False)
+    assert fs.create_file("a", b"q"*500) and not fs.find_file("a").is_small()
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("a")) == b"q"*500
+    fs.close()
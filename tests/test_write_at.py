@@ -0,0 +1,54 @@
+import random
+from conftest import mount, used_blocks
+
+BLOCK = 4096
+
+
+def blocks_of(fs, size:int)->int:
+    """Data and pointer blocks of a file of size octets"""
+    data = -(-size//BLOCK)
+    return data+fs.pointer_blocks(data)
+
+
+def test_write_at_and_truncate_across_remounts(image):
+    rnd = random.Random(5)
+    model = bytearray(rnd.randbytes(BLOCK*3+10))
+    fs = mount(image, small_files=False)
+    assert fs.mkdir("d") and fs.create_file("d/f", bytes(model))
+    empty = used_blocks(fs)-blocks_of(fs, len(model))
+    sizes = [0, 5, BLOCK*4, BLOCK*4+1, BLOCK*1028, BLOCK*1028+3, BLOCK*1029+1, BLOCK*2060+5]
+    for step in range(40):
+        if rnd.random() < 0.5:
+            offset, data = rnd.randrange(0, len(model)+9000), rnd.randbytes(rnd.randrange(1, 20000))
+            assert fs.write_at("d/f", offset, data)
+            model += bytes(max(0, offset-len(model)))
+            model[offset:offset+len(data)] = data
+        else:
+            size = rnd.choice(sizes+[rnd.randrange(0, BLOCK*2100)])
+            assert fs.truncate("d/f", size)
+            del model[size:]
+            model += bytes(size-len(model))
+        if step % 10 == 9:
+            fs.close()
+            fs = mount(image, small_files=False)
+        assert b"".join(fs.read_file("d/f")) == bytes(model)
+        assert used_blocks(fs)-empty == blocks_of(fs, len(model))#freed blocks are not leaked
+    fs.close()
+
+
+def test_write_at_writes_only_covered_blocks(image):
+    fs = mount(image)
+    model = bytearray(b"m"*BLOCK*600)
+    assert fs.create_file("f", bytes(model))
+    fs.flush()
+    writes = []
+    write_many = fs.disk.write_many
+    fs.disk.write_many = lambda pairs: (writes.extend(sector for sector, _ in pairs), write_many(pairs))[1]
+    assert fs.write_at("f", BLOCK*500+4090, b"0123456789")#two data blocks
+    model[BLOCK*500+4090:BLOCK*500+4100] = b"0123456789"
+    fs.flush()
+    assert len([sector for sector in writes if sector >= fs.offset_data]) == 2
+    fs.close()
+    fs = mount(image)
+    assert b"".join(fs.read_file("f")) == bytes(model)
+    fs.close()